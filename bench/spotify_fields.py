@@ -0,0 +1,56 @@
+"""
+Compare the size and decode time of spotify playlist pages with and without
+the fields filter used by redlist.
+
+usage: python bench/spotify_fields.py <playlist id or url> [pages]
+"""
+import sys
+import time
+import json
+import asyncio
+
+import aiohttp
+
+from redlist import playlist
+from redlist import spotify
+
+
+async def fetch_pages(session, playlist_id, pages, fields):
+    "return (bytes downloaded, seconds spent decoding json, tracks parsed)"
+    url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+    size = decode = tracks = 0
+    for page in range(pages):
+        params = {"offset": page * 100, "limit": 100}
+        if fields:
+            params["fields"] = fields
+        async with session.get(url, params=params) as resp:
+            resp.raise_for_status()
+            body = await resp.read()
+        size += len(body)
+        start = time.perf_counter()
+        data = json.loads(body)
+        tracks += len(spotify._parse_page(data["items"]))
+        decode += time.perf_counter() - start
+        if len(data["items"]) < 100:
+            break
+    return size, decode, tracks
+
+
+async def main(playlist_id, pages):
+    token = spotify.SpotifyAccessToken()
+    await token.ensure_valid()
+    async with aiohttp.ClientSession(headers=token.auth_header) as session:
+        for label, fields in (("full", None), ("fields", spotify.PAGE_FIELDS)):
+            size, decode, tracks = await fetch_pages(
+                session, playlist_id, pages, fields
+            )
+            print(
+                f"{label:>7}: {tracks} tracks, {size / 1024:.1f} KiB, "
+                f"{decode * 1000:.1f} ms decoding"
+            )
+
+
+if __name__ == "__main__":
+    argument = sys.argv[1]
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    asyncio.run(main(playlist.parse_spotfiy_id(argument) or argument, pages))
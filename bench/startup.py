@@ -0,0 +1,57 @@
+"""
+Measure how long redlist takes to start, using python -X importtime.
+
+usage: python bench/startup.py [--target MS] [--top N] [module]
+
+Prints the cumulative import time of `module` (default redlist.__main__) and
+its slowest imports. With --target, exits non-zero if startup is slower.
+"""
+import re
+import sys
+import argparse
+import subprocess
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(module):
+    "-> [(self us, cumulative us, depth, name)] for every import made by module"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            times.append((int(own), int(cumulative), len(indent) // 2, name))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("module", nargs="?", default="redlist.__main__")
+    parser.add_argument("--target", type=float, help="fail above this many ms")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    # the best of several runs, the first is usually slowed by a cold disk cache
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    times = min(runs, key=lambda t: sum(own for own, *_ in t))
+    total = sum(own for own, *_ in times) / 1000
+    print(f"import {args.module}: {total:.1f} ms")
+    print(f"\n{'self ms':>8} {'cumul ms':>9}  module")
+    for own, cumulative, depth, name in sorted(times, reverse=True)[: args.top]:
+        print(f"{own / 1000:8.1f} {cumulative / 1000:9.1f}  {name}")
+    if args.target is not None and total > args.target:
+        print(f"\nSlower than the {args.target:.0f} ms target!")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
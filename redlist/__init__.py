@@ -1,5 +1,5 @@
 import confuse
-import pynentry
+import functools
 import logging
 
 logging.basicConfig()
@@ -19,14 +19,20 @@ sensitive = [
 for key in sensitive:
     key.redact = True
 
-# test for pinentry
-try:
-    p = pynentry.PynEntry()
-except FileNotFoundError:
-    log.error('program pinentry could not be found in path.')
-    config['pinentry'] = False
-except OSError:
-    log.debug('Probably not a tty')
-    config['pinentry'] = False
-else:
-    p.close()
+
+@functools.lru_cache(maxsize=None)
+def pinentry_available():
+    'test for pinentry, only done the first time a password is needed'
+    import pynentry
+
+    try:
+        p = pynentry.PynEntry()
+    except FileNotFoundError:
+        log.error('program pinentry could not be found in path.')
+        return False
+    except OSError:
+        log.debug('Probably not a tty')
+        return False
+    else:
+        p.close()
+    return True
@@ -6,21 +6,30 @@ from pathlib import Path
 import logging
 import re
 import argparse
+import signal
 import time
 import os
 
-import beets.library
 import confuse
 
-from .redapi import get_api, API
-from . import redsearch
-from . import playlist
-from . import matching
 from . import utils
 from . import config
-from . import deluge
 from . import ui
 
+# The pipeline pulls in beets, numpy, aiohttp and deluge_client. Load it on
+# first use so --help, --show-config and argument errors return quickly.
+redapi = utils.lazy_import("redlist.redapi")
+redsearch = utils.lazy_import("redlist.redsearch")
+playlist = utils.lazy_import("redlist.playlist")
+matching = utils.lazy_import("redlist.matching")
+deluge = utils.lazy_import("redlist.deluge")
+spotify = utils.lazy_import("redlist.spotify")
+state = utils.lazy_import("redlist.state")
+torrents = utils.lazy_import("redlist.torrents")
+libraries = utils.lazy_import("redlist.library")
+settings = utils.lazy_import("redlist.settings")
+daemon = utils.lazy_import("redlist.daemon")
+
 log = logging.getLogger(__name__)
 log.parent.setLevel("INFO")
 try:
@@ -33,13 +42,14 @@ except IndexError:
 
 
 async def search_redlist_and_dl(unmatched, yes=False):
-    api = await get_api()
+    api = await redapi.get_api()
     log.info("\nConnecting to [REDACTED]...")
     log.info("SUCCESS!")
     log.info("Begining search for %s tracks, This may take a while.", len(unmatched))
 
+    restrict_album = settings.get().restrict_album
+
     async def safe_find_album(track, api):
-        restrict_album = config["restrict_album"].get()
         try:
             return await redsearch.find_album(track, restrict_album=restrict_album)
         except (RuntimeError, ValueError, KeyError) as e:
@@ -47,17 +57,17 @@ async def search_redlist_and_dl(unmatched, yes=False):
             log.debug("Stack Trace:", exc_info=True)
             return None
 
-    tasks = {}
+    tasks = {}  # the same song more than once is searched for once
     for track in unmatched:
-        task = asyncio.ensure_future(safe_find_album(track, api))
-        tasks[track] = task
+        if track.key not in tasks:
+            tasks[track.key] = asyncio.ensure_future(safe_find_album(track, api))
     match_start = time.monotonic()
     await asyncio.gather(*tasks.values())
     match_end = time.monotonic()
     log.info(
         "Searching complete after %s!", humanize.naturaldelta(match_end - match_start)
     )
-    results = {t: v.result() for t, v in tasks.items()}
+    results = {t: tasks[t.key].result() for t in unmatched}
     missing = [t for t, v in results.items() if v is None]
     log.info(
         "Found matches for %d/%d unmatched tracks",
@@ -81,7 +91,7 @@ async def search_redlist_and_dl(unmatched, yes=False):
     # Download torrents
     if not downloads:
         print("No new torrents to download.")
-        return []
+        return missing
     if not yes:
         print("\nWould you like to download the torrents for these albums?:")
     else:
@@ -95,13 +105,17 @@ async def search_redlist_and_dl(unmatched, yes=False):
                 + [torrent["torrent"]["torrentId"]]
             )
             print("\t", m)
+        fl_ids = plan_fl_tokens(downloads, api)
         # get estimated buffer
+        ledger = utils.get_ledger(api)
+        strict = True  # only go past the buffer for downloads the user confirmed
         try:
-            new_buff = await utils.check_dl_buffer(downloads.values(), api)
+            new_buff = await ledger.estimate(downloads.values(), fl_ids)
         except utils.NotEnoughDownloadBuffer as e:
             log.critical("%s", e.args[0])
             if not yes and not re.match("y", input("Continue?: "), re.I):
-                return 0
+                return unmatched
+            strict = False
         else:
             print(
                 f"After download your new buffer will be "
@@ -123,62 +137,122 @@ async def search_redlist_and_dl(unmatched, yes=False):
         if inpt == "e":
             downloads = ui.edit_torrent_downloads(downloads)
 
-    await download_torrents(downloads)
+    await download_torrents(downloads, fl_ids, strict)
     return missing
 
 
-async def dl_torrents_to_deluge(downloads, use_fl=False):
-    api = await get_api()
-    with deluge.Client() as client:
-        paused = bool(config["deluge"]["add_paused"].get())
+def plan_fl_tokens(downloads, api):
+    "torrentIds to spend freeleech tokens on, if enabled"
+    cfg = config["redacted"]
+    if not cfg["use_fl_tokens"].get():
+        return set()
+    # the api does not report a token count. A configured cap covers the whole
+    # run, batch or daemon included, without one every qualifying torrent gets one
+    cap = cfg["fl_tokens"].get()
+    tokens = max(0, int(cap) - api.fl_tokens_used) if cap else None
+    min_size = cfg["fl_min_size"].get(int) * 1024 ** 2
+    fl_ids = utils.plan_fl_tokens(downloads.values(), tokens, min_size)
+    log.info(
+        "Using freeleech tokens on %d of %d torrents (%s).",
+        len(fl_ids),
+        len(downloads),
+        "no cap" if tokens is None else f"{tokens} tokens left",
+    )
+    return fl_ids
 
-        async def add_torrent(torrent):
-            filename, data = await api.get_torrent(
-                torrent["torrent"]["torrentId"], use_fl
-            )
+
+async def dl_torrents_to_deluge(downloads, fl_ids=(), strict=True):
+    api = await redapi.get_api()
+    async with deluge.Client() as client:
+        paused = bool(config["deluge"]["add_paused"].get())
+        # don't spend api calls or fl tokens on torrents deluge already has
+        existing = await client.existing_torrents()
+        for track, group in list(downloads.items()):
+            if deluge.is_added(group["torrent"], existing):
+                log.info("%s is already in deluge, skipping.", group["groupName"])
+                del downloads[track]
+
+        async def add_torrent(track, torrent):
+            torrent_id = torrent["torrent"]["torrentId"]
+            cost = await reserve_buffer(torrent, fl_ids, strict)
+            if cost is None:
+                return
+            res = None
             try:
-                client.add_torrent_file(filename, data, paused)
-            except ValueError:
-                log.error(
-                    "Could not add torrent %s to deluge.",
-                    torrent["torrent"]["torrentId"],
+                filename, data = await api.get_torrent(
+                    torrent_id, torrent_id in fl_ids
                 )
+                res = await client.add_torrent_file(filename, data, paused)
+            except ValueError:
+                log.error("Could not add torrent %s to deluge.", torrent_id)
+            finally:
+                if res is None:
+                    utils.get_ledger(api).release(cost)
+            if res is not None:  # a fallback to saving files leaves it alone
+                del downloads[track]
 
         dls = [
-            asyncio.ensure_future(add_torrent(torrent))
-            for torrent in downloads.values()
+            asyncio.ensure_future(add_torrent(track, torrent))
+            for track, torrent in list(downloads.items())
         ]
-        await asyncio.gather(*dls)
+        # let every add finish before a failure falls back to saving files
+        results = await asyncio.gather(*dls, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise errors[0]
 
     print("Finished.")
     return
 
 
-async def dl_torrent_to_file(torrent, dl_dir, use_fl=False):
-    dl_dir = config["torrent_directory"].as_filename()
-    api = await get_api()
+async def reserve_buffer(torrent, fl_ids=(), strict=True):
+    "reserve buffer for a torrent download -> bytes reserved, None if out of buffer"
+    api = await redapi.get_api()
+    cost = utils.torrent_cost(torrent["torrent"], fl_ids)
+    try:
+        await utils.get_ledger(api).reserve(cost, strict)
+    except utils.NotEnoughDownloadBuffer as e:
+        log.error("Skipping %s: %s", torrent["groupName"], e.args[0])
+        return None
+    return cost
+
+
+async def dl_torrent_to_file(torrent, dl_dir, use_fl=False, strict=True):
+    api = await redapi.get_api()
+    fl_ids = {torrent["torrent"]["torrentId"]} if use_fl else ()
+    cost = await reserve_buffer(torrent, fl_ids, strict)
+    if cost is None:
+        return
+    saved = False
     try:
         filename, data = await api.get_torrent(torrent["torrent"]["torrentId"], use_fl)
+        with open(Path(dl_dir) / filename, "wb") as fout:
+            fout.write(data)
+        saved = True
     except ValueError:
         log.error("Could not download torrent %s.", torrent["torrent"]["torrentId"])
         log.debug("Error details", exc_info=True)
         return
-    with open(Path(dl_dir) / filename, "wb") as fout:
-        fout.write(data)
+    finally:
+        if not saved:
+            utils.get_ledger(api).release(cost)
     log.info("Downloaded %s.", filename)
 
 
-async def download_torrents(downloads):
-    use_fl = bool(config["redacted"]["use_fl_tokens"].get())
+async def download_torrents(downloads, fl_ids=(), strict=True):
+    """
+    download torrents, spending freeleech tokens on those in fl_ids.
+    With strict off they may go past the user's buffer.
+    """
     dl_dir = config["torrent_directory"].as_filename()
-    if use_fl:
+    if len(fl_ids) > 1:
         log.info(
             "Downloading multiple torrents with FL tokens is SLOW, "
             "expect this to take a while."
         )
     if config["enable_deluge"].get():
         try:
-            await dl_torrents_to_deluge(downloads, use_fl)
+            await dl_torrents_to_deluge(downloads, fl_ids, strict)
             return
         except ConnectionRefusedError:
             print("\nThere was an error connecting to the deluge server.")
@@ -186,27 +260,71 @@ async def download_torrents(downloads):
             # Fail out to normal download
 
     # Download to files
+    index = torrents.TorrentIndex(dl_dir)
+    for track, group in list(downloads.items()):
+        saved = index.find(group["torrent"])
+        if saved is not None:
+            log.info(
+                "%s was already downloaded as %s.", group["groupName"], saved.filename
+            )
+            del downloads[track]
 
     dls = [
-        asyncio.ensure_future(dl_torrent_to_file(torrent, dl_dir, use_fl))
+        asyncio.ensure_future(
+            dl_torrent_to_file(
+                torrent, dl_dir, torrent["torrent"]["torrentId"] in fl_ids, strict
+            )
+        )
         for torrent in downloads.values()
     ]
     await asyncio.gather(*dls)
 
 
-async def main(spotlist, yes=False):
-    # Get Beets library
-    dbpath = config["beets_library"].as_filename()
-    library = beets.library.Library(dbpath)
+async def get_index(library):
+    "The library index for this run, or None if disabled"
+    if not config["library_index"].get():
+        return None
+    return await library.get_index()
+
+
+async def match_playlist(spotlist, library):
+    "parse a playlist and match it to the library -> title, matched, unmatched"
+    # build the index while the playlist is being fetched
+    index = asyncio.ensure_future(get_index(library))
+    incremental = config["incremental"].get() and not playlist.is_m3u(spotlist)
+    if incremental:
+        playlist_state = state.PlaylistState.load(spotlist)
+        fingerprint = await state.fingerprint(spotlist)
 
     # Parse the playlist
-    playlist_title, track_info = await playlist.parse_playlist(spotlist, library)
-    log.info('Successfully parsed playlist "%s".', playlist_title)
+    if incremental and playlist_state.tracks and (
+        fingerprint == playlist_state.fingerprint
+    ):
+        log.info('Playlist "%s" is unchanged since last run.', playlist_state.title)
+        playlist_title = playlist_state.title
+        track_info = [t for t, _ in playlist_state.tracks]
+    else:
+        playlist_title, track_info = await playlist.parse_playlist(spotlist, library)
+        log.info('Successfully parsed playlist "%s".', playlist_title)
+    to_match = track_info
+    if incremental:
+        # only new tracks and tracks missing last time need matching
+        to_match = await library.run(playlist_state.resolve, library.lib, track_info)
+        log.info(
+            "Reusing %d tracks resolved on a previous run.",
+            sum(1 for i in to_match.values() if i is not None),
+        )
     # Match exsisting tracks
     log.info("Matching track list to beets library...")
-    matched = matching.beets_match(
-        track_info, library, bool(config["restrict_album"].get())
+    matched = await library.match(
+        to_match,
+        settings.get().restrict_album,
+        index=await index,
+        workers=config["match_workers"].get(int),
     )
+    if incremental:
+        playlist_state.update(fingerprint, playlist_title, matched)
+        playlist_state.save()
     unmatched = [
         track
         for track, i in matched.items()
@@ -217,49 +335,71 @@ async def main(spotlist, yes=False):
         len(unmatched),
         len(track_info),
     )
-    if re.match(r".*\.(m3u|m3u8)$", spotlist) and config["overwrite_m3u"].get():
+    return playlist_title, matched, unmatched
+
+
+def save_m3u(spotlist, playlist_title, matched, yes=False):
+    if playlist.is_m3u(spotlist) and config["overwrite_m3u"].get():
         save_path = Path(spotlist)
         overwrite_flag = True
     else:
         save_dir = config["m3u_directory"].as_filename()
         save_path = Path(save_dir) / "{}.m3u".format(playlist_title)
         overwrite_flag = False
+    url = spotlist if playlist.parse_spotfiy_id(spotlist) else None
+    if save_path.exists() and save_path.read_bytes() == playlist.render_m3u(
+        matched, url
+    ):
+        log.info("%s is already up to date.", save_path)
+        return
     if save_path.exists() and not overwrite_flag:
         if yes or re.match(r"y", input("\nOverwrite %s?: " % save_path)):
-            playlist.create_m3u_from_info(
-                matched,
-                save_path,
-                url=spotlist if playlist.parse_spotfiy_id(spotlist) else None,
-            )
+            playlist.create_m3u_from_info(matched, save_path, url=url)
     else:
-        playlist.create_m3u_from_info(
-            matched,
-            save_path,
-            url=spotlist if playlist.parse_spotfiy_id(spotlist) else None,
-        )
+        playlist.create_m3u_from_info(matched, save_path, url=url)
 
-    if len(unmatched) == 0:
-        return 0
+
+async def search_missing(unmatched, yes=False):
+    "Search [REDACTED] for unmatched tracks, returns the tracks still missing"
     print("\nThe following tracks could not be matched to your beets library:")
     print("\n".join(map(str, unmatched)))
 
-    # Search [REDACTED] for missing tracks
     redacted_disabled = config["redacted"]["disable"].get()
     if redacted_disabled:
         log.info("\nSearching Redacted is Disabled by config.")
-    if not redacted_disabled:
-        if yes or re.match(
-            r"y", input("\nSearch [REDACTED] for missing tracks?(y/n): "), flags=re.I
-        ):
-            unmatched = await search_redlist_and_dl(unmatched, yes=yes)
+        return unmatched
+    if yes or re.match(
+        r"y", input("\nSearch [REDACTED] for missing tracks?(y/n): "), flags=re.I
+    ):
+        unmatched = await search_redlist_and_dl(unmatched, yes=yes)
 
-        if unmatched:
-            print(
-                "\nThe Following tracks could not be found in beets OR on [REDACTED]:"
-            )
-            for t in unmatched:
-                print(t)
+    if unmatched:
+        print("\nThe Following tracks could not be found in beets OR on [REDACTED]:")
+        for t in unmatched:
+            print(t)
+    return unmatched
+
+
+async def update_missing_playlist(spotlist, playlist_title, unmatched):
+    "fill the missing tracks playlist, re-using the one made on earlier runs"
+    playlist_state = state.PlaylistState.load(spotlist)
+    playlist_id = await playlist.make_missing_spotify_playlist(
+        playlist_title, unmatched, playlist_state.missing_playlist
+    )
+    if playlist_id != playlist_state.missing_playlist:
+        playlist_state.missing_playlist = playlist_id
+        playlist_state.save()
+
+
+async def offer_missing_playlist(spotlist, playlist_title, unmatched, prompt=True):
+    if not unmatched:
+        # empty the playlist made on an earlier run, the tracks are all found now
+        if state.PlaylistState.load(spotlist).missing_playlist:
+            await update_missing_playlist(spotlist, playlist_title, [])
+        return
     missing_track_playlist = config["missing_track_playlist"].get()
+    if missing_track_playlist is None and not prompt:
+        return
     if (
         (missing_track_playlist == "yes" and missing_track_playlist != "no")
         or missing_track_playlist is not None
@@ -271,14 +411,102 @@ async def main(spotlist, yes=False):
             flags=re.I,
         )
     ):
-        await playlist.make_missing_spotify_playlist(playlist_title, unmatched)
+        await update_missing_playlist(spotlist, playlist_title, unmatched)
+
+
+async def main(spotlist, yes=False, prompt=True):
+    # Get Beets library
+    dbpath = config["beets_library"].as_filename()
+    library = libraries.get_library(dbpath)
+
+    playlist_title, matched, unmatched = await match_playlist(spotlist, library)
+    save_m3u(spotlist, playlist_title, matched, yes)
+
+    if len(unmatched) == 0:
+        await offer_missing_playlist(spotlist, playlist_title, unmatched, prompt)
+        return 0
+
+    # Search [REDACTED] for missing tracks
+    unmatched = await search_missing(unmatched, yes)
+    await offer_missing_playlist(spotlist, playlist_title, unmatched, prompt)
     print("Finished.")
     return 0
 
 
+async def run_daemon(playlists, stop=None):
+    """
+    Watch playlists for changes and process them as they do, keeping the
+    library index, api sessions and caches warm between runs. Stops between
+    jobs once the `stop` Event is set.
+    """
+    playlists = list(dict.fromkeys(playlists + config["daemon"]["playlists"].get()))
+    if not playlists:
+        log.error("No playlists to watch, add some to daemon.playlists.")
+        return 1
+    dbpath = config["beets_library"].as_filename()
+    library = libraries.get_library(dbpath)
+    await get_index(library)
+
+    async def process(spotlist):
+        library.refresh()
+        # the buffer changes between jobs, start each one from a fresh figure
+        if utils.LEDGER is not None:
+            utils.LEDGER.reset()
+        await main(spotlist, yes=True, prompt=False)
+
+    await daemon.watch(
+        playlists, process, config["daemon"]["interval"].get(int), stop=stop
+    )
+    log.info("Stopping daemon.")
+    return 0
+
+
+async def main_batch(spotlists, yes=False):
+    """
+    Process several playlists as one job. Playlists are parsed and matched
+    concurrently, and their unmatched tracks are searched for and downloaded
+    together, so a track shared between playlists is only handled once.
+    """
+    dbpath = config["beets_library"].as_filename()
+    library = libraries.get_library(dbpath)
+
+    results = await asyncio.gather(
+        *(match_playlist(s, library) for s in spotlists), return_exceptions=True
+    )
+    playlists = []
+    status = 0
+    for spotlist, result in zip(spotlists, results):
+        if isinstance(result, Exception):
+            log.error("Error Processing %s.", spotlist, exc_info=result)
+            status = 1
+            continue
+        playlist_title, matched, unmatched = result
+        save_m3u(spotlist, playlist_title, matched, yes)
+        playlists.append((spotlist, playlist_title, unmatched))
+
+    # dict keeps playlist order while dropping tracks shared between playlists
+    unmatched = list({t.key: t for *_, u in playlists for t in u}.values())
+    still_missing = set()
+    if unmatched:
+        log.info(
+            "%d unmatched tracks across %d playlists.", len(unmatched), len(playlists)
+        )
+        still_missing = {t.key for t in await search_missing(unmatched, yes)}
+    for spotlist, playlist_title, tracks in playlists:
+        missing = [t for t in tracks if t.key in still_missing]
+        await offer_missing_playlist(spotlist, playlist_title, missing)
+    if unmatched:
+        print("Finished.")
+    return status
+
+
 async def cli():
     parser = argparse.ArgumentParser(
-        usage="redlist [options] <playlist>...", description=__doc__
+        usage=(
+            "redlist [options] <playlist>...\n"
+            "       redlist [options] daemon [playlist]..."
+        ),
+        description=__doc__,
     )
     parser.add_argument("playlist", nargs="*")
     parser.add_argument(
@@ -322,6 +550,12 @@ async def cli():
         const=True,
         help="Only match tracks if they come from the same album.",
     )
+    parser.add_argument(
+        "--match-workers",
+        dest="match_workers",
+        type=int,
+        help="Number of processes to use when matching against the beets library.",
+    )
     parser.add_argument(
         "--use-fl-tokens",
         dest="redacted.use_fl_tokens",
@@ -329,6 +563,22 @@ async def cli():
         action="store_const",
         const=True,
     )
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_const",
+        const=True,
+        help="Only match tracks that are new or were missing on the last run.",
+    )
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        action="store_true",
+        help=(
+            "Process all playlists together, searching for and downloading "
+            "their missing tracks once."
+        ),
+    )
     parser.add_argument(
         "--show-config",
         dest="show_config",
@@ -375,23 +625,57 @@ async def cli():
         print(config.dump(redact=options.redact))
         return 0
     args = options.playlist
+    daemon_mode = bool(args) and args[0] == "daemon"
     if len(args) < 1:
         parser.error("Must specify at least one playlist")
     log.parent.setLevel(getattr(logging, options.loglevel))
     config.set_args(options, dots=True)
     utils.resolve_configured_paths(config)
+    settings.load()
     spotlists = args
     results = []
-    for splist in spotlists:
+    if daemon_mode:
+        # stop between jobs on ctrl-c or SIGTERM, a second signal stops right
+        # away, and still clean up below
+        loop = asyncio.get_event_loop()
+        task = asyncio.current_task()
+        stop = asyncio.Event()
+
+        def on_signal():
+            if stop.is_set():
+                task.cancel()
+            else:
+                log.info("Stopping after the current job.")
+                stop.set()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, on_signal)
+            except NotImplementedError:  # windows
+                pass
+        try:
+            results.append(await run_daemon(spotlists[1:], stop))
+        except asyncio.CancelledError:
+            log.info("Daemon stopped mid job.")
+    elif options.batch:
         try:
-            results.append(await main(splist, options.yes))
+            results.append(await main_batch(spotlists, options.yes))
         except Exception:
-            log.error("Error Processing %s.", splist, exc_info=True)
+            log.error("Error Processing playlists.", exc_info=True)
             results.append(1)
-
-    if API is not None:
-        api = await get_api()
-        await api.session.close()
+    else:
+        for splist in spotlists:
+            try:
+                results.append(await main(splist, options.yes))
+            except Exception:
+                log.error("Error Processing %s.", splist, exc_info=True)
+                results.append(1)
+
+    log.info("Cache hit rates: %s", matching.cache_summary())
+    libraries.close_libraries()
+    await spotify.close_client()
+    if redapi.API is not None:
+        await redapi.API.session.close()
     if not all(r == 0 for r in results):
         return 1
     else:
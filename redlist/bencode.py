@@ -0,0 +1,58 @@
+"Minimal bencode decoder for reading .torrent files"
+import hashlib
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def _decode(data, i, spans):
+    c = data[i : i + 1]
+    if c == b"i":
+        end = data.index(b"e", i)
+        return int(data[i + 1 : end]), end + 1
+    if c == b"l":
+        i += 1
+        items = []
+        while data[i : i + 1] != b"e":
+            item, i = _decode(data, i, spans)
+            items.append(item)
+        return items, i + 1
+    if c == b"d":
+        i += 1
+        d = {}
+        while data[i : i + 1] != b"e":
+            key, i = _decode(data, i, spans)
+            start = i
+            d[key], i = _decode(data, i, spans)
+            if key == b"info":
+                spans.append((start, i))
+        return d, i + 1
+    if c.isdigit():
+        colon = data.index(b":", i)
+        end = colon + 1 + int(data[i:colon])
+        if end > len(data):
+            raise BencodeError("string runs past the end of the data")
+        return data[colon + 1 : end], end
+    raise BencodeError(f"unexpected {c!r} at {i}")
+
+
+def decode(data):
+    "decode bencoded bytes, strings are left as bytes"
+    return decode_torrent(data)[0]
+
+
+def decode_torrent(data):
+    "decode a .torrent file -> (metainfo, info-hash hex digest or None)"
+    spans = []
+    try:
+        value, end = _decode(data, 0, spans)
+    except (IndexError, ValueError) as e:
+        raise BencodeError(str(e)) from e
+    if end != len(data):
+        raise BencodeError("trailing data after bencoded value")
+    info_hash = None
+    if spans:  # the top level info dict is the last one closed
+        start, stop = spans[-1]
+        info_hash = hashlib.sha1(data[start:stop]).hexdigest()
+    return value, info_hash
@@ -0,0 +1,102 @@
+import os
+import json
+import asyncio
+import logging
+from pathlib import Path
+
+from . import config
+from . import playlist
+from . import spotify
+
+log = logging.getLogger(__name__)
+
+
+async def poll_fingerprint(argument):
+    "A cheap value that changes when the playlist does: snapshot_id or file mtime"
+    spotify_id = playlist.parse_spotfiy_id(argument)
+    if spotify_id:
+        return await spotify.fetch_snapshot_id(spotify_id)
+    return str(os.stat(argument).st_mtime_ns)
+
+
+class JobQueue:
+    """
+    Playlists waiting to be processed and the fingerprint each was last
+    processed at. Saved to the config dir so a restarted daemon carries on.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = Path(config.config_dir()) / "daemon_jobs.json"
+        self.path = Path(path)
+        self.pending = {}  # source -> fingerprint, in the order they were queued
+        self.seen = {}  # source -> fingerprint
+        try:
+            with open(self.path) as fin:
+                data = json.load(fin)
+            self.pending = dict(data["pending"])
+            self.seen = data["seen"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+            log.debug("Starting with an empty job queue: %s", e)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as fout:
+            json.dump({"pending": list(self.pending.items()), "seen": self.seen}, fout)
+
+    def push(self, source, fingerprint):
+        "queue source if it changed since it was last processed"
+        if self.seen.get(source) == fingerprint or source in self.pending:
+            return False
+        self.pending[source] = fingerprint
+        self.save()
+        return True
+
+    def done(self, source):
+        self.seen[source] = self.pending.pop(source)
+        self.save()
+
+    def __len__(self):
+        return len(self.pending)
+
+
+async def poll(playlists, queue):
+    "queue every playlist that changed since it was last processed"
+    for source in playlists:
+        try:
+            fingerprint = await poll_fingerprint(source)
+        except Exception:
+            log.error("Could not check %s for changes.", source)
+            log.debug("Error details:", exc_info=True)
+            continue
+        if queue.push(source, fingerprint):
+            log.info("%s has changed, queued.", source)
+
+
+async def watch(playlists, process, interval=600, queue=None, once=False, stop=None):
+    """
+    Poll playlists every `interval` seconds and await process(source) for
+    each one that changed. Failed jobs stay queued and are retried next cycle.
+    Setting the `stop` Event ends the watch once the current job is done.
+    """
+    queue = queue if queue is not None else JobQueue()
+    stop = stop if stop is not None else asyncio.Event()
+    log.info("Watching %d playlists every %d seconds.", len(playlists), interval)
+    while not stop.is_set():
+        await poll(playlists, queue)
+        for source in list(queue.pending):
+            if stop.is_set():
+                break
+            try:
+                await process(source)
+            except Exception:
+                log.error("Error Processing %s, will retry.", source, exc_info=True)
+            else:
+                queue.done(source)
+        if once:
+            break
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+    return queue
@@ -6,14 +6,31 @@ from pathlib import Path
 import asyncio
 import logging
 import functools
+from collections import namedtuple
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from . import config
 from . import ui
 
 log = logging.getLogger(__name__)
 
+# Announce host of [REDACTED] torrents
+TRACKER = 'flacsfor.me'
+
+ExistingTorrents = namedtuple('ExistingTorrents', 'hashes names')
+
 
 class Client:
+    """
+    Deluge RPC client usable from coroutines. Calls are made on a dedicated
+    thread with its own connection so they never block the event loop, and
+    the connection is re-established if the daemon drops it.
+    use as `async with Client() as client:` or await client.connect()
+    """
+
+    RECONNECT_ATTEMPTS = 3
+
     def __init__(self):
         cfg = config['deluge']
         self.cfg = cfg
@@ -25,8 +42,15 @@ class Client:
             cfg['password'].get(),
             decode_utf8=True,
         )
-        self._loop = asyncio.get_event_loop()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='redlist-deluge')
 
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args)
+        )
+
+    def _connect(self):
         try:
             self._client.connect()
             log.info('Connected to %s:%d', self._client.host, self._client.port)
@@ -35,11 +59,33 @@ class Client:
             log.debug('Error Details:', exc_info=True)
             raise
 
-    def add_torrent_file(self, filename, data, paused=False):
+    def _call(self, method, *args):
+        "call method on the deluge daemon, reconnecting if the connection is lost"
+        for attempt in range(self.RECONNECT_ATTEMPTS):
+            try:
+                if not self._client.connected:
+                    self._connect()
+                return self._client.call(method, *args)
+            except (deluge_client.client.FailedToReconnectException, OSError):
+                log.warning('Lost connection to deluge, reconnecting.')
+                log.debug('Error details:', exc_info=True)
+                self._client.disconnect()
+                time.sleep(2 ** attempt)
+        self._connect()
+        return self._client.call(method, *args)
+
+    async def connect(self):
+        await self._run(self._connect)
+
+    async def call(self, method, *args):
+        return await self._run(self._call, method, *args)
+
+    async def add_torrent_file(self, filename, data, paused=False):
         options = {'add_paused': paused} if paused else {}
         data = base64.encodebytes(data)
+        start = time.perf_counter()
         try:
-            res = self._client.call('core.add_torrent_file', filename, data, options)
+            res = await self.call('core.add_torrent_file', filename, data, options)
         except deluge_client.client.RemoteException as e:
             if e.__class__.__name__ == 'AddTorrentError':
                 res = None
@@ -47,18 +93,53 @@ class Client:
                 log.error('Problem Adding torrent %s.', filename, exc_info=True)
                 log.debug('Error details', exc_info=True)
                 return None
+        latency = time.perf_counter() - start
         if res is None:
             log.error('Problem when adding torrent %s, it may already exsist.', filename)
             log.debug('Error details:', exc_info=True)
         else:
             log.info('Added torrent %s with hash %s.', filename, res)
+        log.debug('Adding %s took %.3f seconds.', filename, latency)
         return res
 
-    def __enter__(self):
+    async def existing_torrents(self):
+        "The info-hashes of every torrent in the session, and names of [REDACTED] ones"
+        status = await self.call('core.get_torrents_status', {}, ['name', 'trackers'])
+        hashes = {h.lower() for h in status}
+        names = {
+            t['name']
+            for t in status.values()
+            if any(TRACKER in tr['url'] for tr in t.get('trackers', []))
+        }
+        log.debug('%d torrents already in deluge.', len(hashes))
+        return ExistingTorrents(hashes, names)
+
+    def _close(self):
+        if self._client.connected:
+            self._client.disconnect()
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        try:
+            await self.connect()
+        except Exception:
+            self._executor.shutdown(wait=False)
+            raise
         return self
 
-    def __exit__(self, exc_type, value, traceback):
-        self._client.disconnect()
+    async def __aexit__(self, exc_type, value, traceback):
+        await self.close()
+
+
+def is_added(torrent, existing):
+    "is the chosen torrent of a torrent group already in deluge"
+    info_hash = torrent.get('infoHash')
+    if info_hash:
+        return info_hash.lower() in existing.hashes
+    return torrent.get('filePath') in existing.names
 
 
 def resolve_password(config_path=None):
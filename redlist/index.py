@@ -0,0 +1,156 @@
+import re
+import logging
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, Counter
+
+from unidecode import unidecode
+
+from . import matching
+
+log = logging.getLogger(__name__)
+
+IndexEntry = namedtuple("IndexEntry", "id title artist album length path")
+
+# Spotify style version suffixes, ie: "Song - 2011 Remaster", "Song - Live"
+VERSION_SUFFIX = re.compile(
+    r"\s+-\s+[^-]*\b(remaster(ed)?|version|edit|mix|mono|stereo|live|demo)\b.*$"
+)
+VERSION_BRACKETS = re.compile(
+    r"[\(\[][^\)\]]*\b(remaster(ed)?|feat|ft|featuring|with)\b[^\)\]]*[\)\]]"
+)
+ROMAN = {"i": "1", "ii": "2", "iii": "3", "iv": "4", "v": "5", "vi": "6",
+         "vii": "7", "viii": "8", "ix": "9", "x": "10"}
+
+
+def normalize_title(title):
+    "Reduce a track title to a canonical form for fuzzy lookups"
+    title = unidecode(title or "").lower()
+    title = VERSION_SUFFIX.sub("", title)
+    title = VERSION_BRACKETS.sub("", title)
+    title = title.replace("&", " and ")
+    title = re.sub(r"\bpt\b\.?", "part", title)
+    title = re.sub(
+        r"\b(part|vol|volume|no) (i|ii|iii|iv|v|vi|vii|viii|ix|x)\b",
+        lambda m: f"{m.group(1)} {ROMAN[m.group(2)]}",
+        title,
+    )
+    title = re.sub(r"[^a-z0-9]+", " ", title)
+    return title.strip()
+
+
+def normalize_artist(artist):
+    "Reduce an artist name to a canonical form for fuzzy lookups"
+    artist = unidecode(artist or "").lower().replace("&", " and ")
+    return re.sub(r"[^a-z0-9]+", " ", artist).strip()
+
+
+def _length_key(entry):
+    return (0, entry.length) if entry.length else (1, 0)
+
+
+def trigrams(text):
+    "return the set of character trigrams for an already normalized string"
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class LibraryIndex:
+    """
+    Inverted trigram index over the normalized titles and artists of a beets
+    library. Returns the closest canidates for a track without going through
+    beets' substring queries.
+    """
+
+    def __init__(self, lib, max_postings=None):
+        self.entries = []
+        self.postings = {}
+        self.gram_counts = array("H")
+        self.artist_postings = {}
+        self.artist_gram_counts = array("H")
+        with lib.transaction() as tx:
+            rows = tx.query("SELECT id, title, artist, album, length, path FROM items")
+        # Entries are numbered in order of length (unknown lengths last) so a
+        # window of allowed lengths is a contiguous range of positions.
+        entries = sorted((IndexEntry(*row) for row in rows), key=_length_key)
+        self.lengths = array("d", (e.length for e in entries if e.length))
+        for entry in entries:
+            self._add(entry)
+        self.postings = {g: array("I", p) for g, p in self.postings.items()}
+        self.artist_postings = {
+            g: array("I", p) for g, p in self.artist_postings.items()
+        }
+        if max_postings is None:
+            max_postings = max(500, len(self.entries) // 50)
+        self.max_postings = max_postings
+        log.debug("Indexed %d library items.", len(self.entries))
+
+    def _add(self, entry):
+        pos = len(self.entries)
+        grams = trigrams(normalize_title(entry.title))
+        self.entries.append(entry)
+        self.gram_counts.append(len(grams))
+        for g in grams:
+            self.postings.setdefault(g, []).append(pos)
+        grams = trigrams(normalize_artist(entry.artist))
+        self.artist_gram_counts.append(len(grams))
+        for g in grams:
+            self.artist_postings.setdefault(g, []).append(pos)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def length_range(self, window):
+        "positions of the entries inside a (min, max) length window"
+        if window is None:
+            return 0, len(self.entries)
+        lo, hi = window
+        return bisect_left(self.lengths, lo), bisect_right(self.lengths, hi)
+
+    def _count(self, postings, grams, start, stop, common=True):
+        "count the grams shared with every entry in positions start:stop"
+        postings = sorted((postings[g] for g in grams if g in postings), key=len)
+        counts = Counter()
+        if not postings:
+            return counts
+        unknown = len(self.lengths)
+        # very common grams carry little signal and dominate the work, skip them
+        # unless nothing else is available
+        rare = [p for p in postings if len(p) <= self.max_postings]
+        if not rare and common:
+            rare = postings[:3]
+        for p in rare:
+            counts.update(p[bisect_left(p, start) : bisect_left(p, stop)])
+            if stop <= unknown:
+                counts.update(p[bisect_left(p, unknown) :])
+        return counts
+
+    def candidates(self, track_info, limit=20, restrict_album=False):
+        """
+        return up to `limit` IndexEntries whose titles best match track_info.title,
+        ranked by title and artist similarity, skipping entries whose length
+        rules them out.
+        """
+        window = matching.length_window(track_info.length, restrict_album)
+        start, stop = self.length_range(window)
+        grams = trigrams(normalize_title(track_info.title))
+        counts = self._count(self.postings, grams, start, stop)
+        if not counts:
+            return []
+        # the artist only ranks entries that share some of the title, otherwise
+        # a common title could push the right artist's song out of the limit
+        artist_grams = trigrams(normalize_artist(track_info.artist))
+        artist_counts = self._count(
+            self.artist_postings, artist_grams, start, stop, common=False
+        )
+        q, qa = len(grams), len(artist_grams)
+
+        def score(c):
+            pos, shared = c
+            title = 2 * shared / (q + self.gram_counts[pos])
+            artist = 2 * artist_counts[pos] / (qa + self.artist_gram_counts[pos])
+            return title + artist
+
+        best = heapq.nlargest(limit, counts.items(), key=score)
+        return [self.entries[pos] for pos, _ in best]
@@ -0,0 +1,125 @@
+import os
+import asyncio
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import beets.library
+
+from . import matching
+from .index import LibraryIndex
+
+log = logging.getLogger(__name__)
+LIBRARIES = {}
+
+_worker = threading.local()
+
+
+def _mark_read_only():
+    _worker.read_only = True
+
+
+class ReadOnlyLibrary(beets.library.Library):
+    "beets Library that hands library worker threads read only SQLite connections"
+
+    def _create_connection(self):
+        conn = super()._create_connection()
+        if getattr(_worker, "read_only", False):
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+
+class AsyncLibrary:
+    """
+    Runs beets library queries on a thread pool so they do not block the event
+    loop. The wrapped library is available as `lib` for synchronous use.
+    Should not be instantiated directly; instead use get_library()
+    """
+
+    def __init__(self, path, workers=2):
+        self.lib = ReadOnlyLibrary(path)
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="redlist-library", initializer=_mark_read_only
+        )
+        self._index = None
+        self._index_mtime = None
+        self._pool = None
+        self._pool_index = None
+
+    async def run(self, func, *args, **kwargs):
+        "run func(*args, **kwargs) on the library thread pool"
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def items(self, query=None):
+        return await self.run(lambda: list(self.lib.items(query)))
+
+    async def build_index(self):
+        return await self.run(LibraryIndex, self.lib)
+
+    def _mtime(self):
+        try:
+            return os.stat(self.lib.path).st_mtime_ns
+        except (OSError, TypeError, ValueError):
+            return None
+
+    async def get_index(self):
+        "The LibraryIndex for this library, built once and shared by all callers"
+        if self._index is None:
+            self._index_mtime = self._mtime()
+            self._index = asyncio.ensure_future(self.build_index())
+        return await self._index
+
+    def refresh(self):
+        "drop the cached index if the library has changed since it was built"
+        if self._index is not None and self._mtime() != self._index_mtime:
+            log.debug("Library changed, the index will be rebuilt.")
+            self._index = None
+
+    def match_pool(self, index, workers):
+        "the process pool matching against index, shared by every playlist"
+        if self._pool_index is not index:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool = matching.match_pool(index, workers)
+            self._pool_index = index
+        return self._pool
+
+    async def match(self, track_info, restrict_album=False, index=None, workers=None):
+        pool = None
+        if index is not None and workers and workers > 1:
+            # made here on the event loop thread, not by a library thread
+            pool = self.match_pool(index, workers)
+        return await self.run(
+            matching.beets_match,
+            track_info,
+            self.lib,
+            restrict_album,
+            index=index,
+            workers=workers,
+            pool=pool,
+        )
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        self.lib._close()
+
+
+def get_library(path):
+    "Return the AsyncLibrary for path, re-using an open one"
+    try:
+        return LIBRARIES[path]
+    except KeyError:
+        library = LIBRARIES[path] = AsyncLibrary(path)
+        return library
+
+
+def close_libraries():
+    while LIBRARIES:
+        _, library = LIBRARIES.popitem()
+        library.close()
@@ -1,13 +1,24 @@
 import re
+import html
+import math
+import functools
 import shlex
 import json
 import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, namedtuple
 from itertools import zip_longest
 
+import numpy as np
 import beets.autotag as beets_tagger
-from beets import config as beetconfig
+from beets.autotag.distance import SD_END_WORDS, SD_PATTERNS, SD_REPLACE
+from unidecode import unidecode
 
-from . import config
+from . import settings
+from . import utils
 
 VA_ARTISTS = "", "various artists", "various", "va", "unknown"
 
@@ -33,22 +44,24 @@ class TrackInfo:
         album: Title of the album the track is from
         length: Length of track in mm:ss format
 
-    All other keyword arguments will be stored as attributes.
+    All other keyword arguments will be stored as attributes in `extras`.
+
+    `key` is the normalized artist, title, album and length at creation, the
+    same for a song repeated in a playlist or read from two sources.
     """
 
+    CORE_FIELDS = ("artist", "title", "album", "length")
+    __slots__ = CORE_FIELDS + ("extras", "_key")
+
     def __init__(self, *args, **kwargs):
         if "json" in kwargs:
             kwargs = json.loads(kwargs["json"])
             args = []
-        arg_order = ["artist", "title", "album", "length"]
-        self.fields = []
-        for k, v in zip_longest(arg_order, args):
-            self.fields.append(k)
+        self.extras = {}
+        for k, v in zip_longest(self.CORE_FIELDS, args):
             self.__setattr__(k, v.strip() if v else None)
         if kwargs:
             for k, v in kwargs.items():
-                if k not in self.fields:
-                    self.fields.append(k)
                 try:
                     self.__setattr__(k, v.strip())
                 except AttributeError:
@@ -60,6 +73,35 @@ class TrackInfo:
             self.convert_length()
         except AttributeError:
             pass
+        self._key = (
+            _sd_basic(self.artist),
+            _sd_basic(self.title),
+            _sd_basic(self.album or ""),
+            round(self.length) if self.length else None,
+        )
+
+    def __setattr__(self, name, value):
+        if name in TrackInfo.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            self.extras[name] = value
+
+    def __getattr__(self, name):
+        # only called for names that are not slots
+        if name.startswith("__") or name in TrackInfo.__slots__:
+            raise AttributeError(name)
+        try:
+            return self.extras[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def fields(self):
+        return list(self.CORE_FIELDS) + [k for k in self.extras]
 
     def _clean_feat(self):
         fields = ["artist"]
@@ -68,12 +110,11 @@ class TrackInfo:
             self.artist = sp[0]
         for f in fields:
             m = re.match(
-                r"(.+?)[\s\-]+(, |feat(\. |uring )?)(.+)", self.__getattribute__(f)
+                r"(.+?)[\s\-]+(, |feat(\. |uring )?)(.+)", getattr(self, f)
             )
             if m:
                 self.feat = m.groups()[-1]
                 self.__setattr__(f, m.group(1))
-                self.fields.append("feat")
                 log.debug("Cleaned featured artist %s from %s field.", self.feat, f)
 
     def convert_length(self):
@@ -115,13 +156,13 @@ class TrackInfo:
         return cls(**kwargs)
 
     def json(self):
-        return json.dumps({f: self.__getattribute__(f) for f in self.fields})
+        return json.dumps({f: getattr(self, f) for f in self.fields})
 
     def __str__(self):
         return f'{self.artist}{" - "+self.album if self.album else ""} - {self.title}'
 
     def __repr__(self):
-        d = ["=".join((f, repr(self.__getattribute__(f)))) for f in self.fields]
+        d = ["=".join((f, repr(getattr(self, f)))) for f in self.fields]
         return f'{self.__class__.__name__}({", ".join(d)})'
 
 
@@ -129,10 +170,9 @@ def track_distance(item, track_info, restrict_album=False):
     dist = beets_tagger.distance.Distance()
 
     if item.length and track_info.length:
-        grace = beetconfig["match"]["track_length_grace"].as_number()
-        length_max = beetconfig["match"]["track_length_max"].as_number()
-        diff = abs(item.length - track_info.length) - grace
-        dist.add_ratio("track_length", diff, length_max)
+        s = settings.get()
+        diff = abs(item.length - track_info.length) - s.track_length_grace
+        dist.add_ratio("track_length", diff, s.track_length_max)
 
     dist.add_string("track_title", item.title, track_info.title)
 
@@ -145,46 +185,481 @@ def track_distance(item, track_info, restrict_album=False):
     return dist
 
 
+SD_COMPILED = [(re.compile(pat), weight) for pat, weight in SD_PATTERNS]
+NON_ALNUM = re.compile(r"[^a-z0-9]")
+
+NORMALIZE_CACHE_SIZE = 2 ** 16
+DISTANCE_CACHE_SIZE = 2 ** 18
+
+
+CacheInfo = namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+
+class DistanceCache:
+    "Bounded LRU mapping of string pairs to their distance, safe to share by threads"
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(a, b):
+        # string_dist is symmetric, so (a, b) and (b, a) share an entry
+        return (a, b) if a <= b else (b, a)
+
+    def get(self, a, b):
+        key = self.key(a, b)
+        with self._lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, a, b, value):
+        key = self.key(a, b)
+        with self._lock:
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.data.clear()
+            self.hits = self.misses = 0
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
+
+
+DISTANCES = DistanceCache(DISTANCE_CACHE_SIZE)
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_name(name):
+    "html unescaped, lowercase form of an artist or album name from [REDACTED]"
+    return html.unescape(name).lower()
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def unescape(name):
+    return html.unescape(name)
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _sd_clean(s):
+    "the lowercasing and substitutions beets' string_dist applies before comparing"
+    s = s.lower()
+    for word in SD_END_WORDS:
+        if s.endswith(f", {word}"):
+            s = f"{word} {s[: -len(word) - 2]}"
+    for pat, repl in SD_REPLACE:
+        s = re.sub(pat, repl, s)
+    return s
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _sd_basic(s):
+    return NON_ALNUM.sub("", unidecode(s).lower())
+
+
+def levenshtein_batch(query, canidates):
+    "edit distance from query to each canidate string as an integer array"
+    lengths = np.fromiter((len(c) for c in canidates), dtype=np.int64)
+    if not len(canidates):
+        return lengths
+    width = int(lengths.max())
+    codes = np.frombuffer("".join(canidates).encode("utf-32-le"), dtype=np.uint32)
+    encoded = np.zeros((len(canidates), width), dtype=np.uint32)
+    encoded[np.arange(width) < lengths[:, None]] = codes
+    cols = np.arange(width + 1, dtype=np.int32)
+    row = np.broadcast_to(cols, (len(canidates), width + 1)).copy()
+    for k, char in enumerate(query, 1):
+        cost = encoded != ord(char)
+        new = np.empty_like(row)
+        new[:, 0] = k
+        np.minimum(row[:, 1:] + 1, row[:, :-1] + cost, out=new[:, 1:])
+        # insertions along the row are resolved with a running minimum
+        row = np.minimum.accumulate(new - cols, axis=1) + cols
+    return row[np.arange(len(canidates)), lengths]
+
+
+def _basic_dist_batch(query, canidates):
+    "beets' _string_dist_basic for one query and many canidates"
+    query = _sd_basic(query)
+    canidates = [_sd_basic(c) for c in canidates]
+    lengths = np.fromiter((len(c) for c in canidates), dtype=np.float64)
+    longest = np.maximum(lengths, len(query))
+    edits = levenshtein_batch(query, canidates)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(longest > 0, edits / longest, 0.0)
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _sd_strip(pat, s):
+    return pat.sub("", s)
+
+
+def string_distances(query, canidates):
+    """
+    Batch version of beets' string_dist. Returns an array holding the distance
+    between query and each canidate. Pairs seen before are served from DISTANCES.
+    """
+    dists = np.empty(len(canidates))
+    todo = []
+    for i, c in enumerate(canidates):
+        if query is None or c is None:
+            dists[i] = 0.0 if query is None and c is None else 1.0
+            continue
+        cached = DISTANCES.get(query, c)
+        if cached is None:
+            todo.append(i)
+        else:
+            dists[i] = cached
+    if todo:
+        todo_strings = [canidates[i] for i in todo]
+        computed = _string_distances(query, todo_strings)
+        dists[todo] = computed
+        for c, d in zip(todo_strings, computed):
+            DISTANCES.set(query, c, float(d))
+    return dists
+
+
+def _string_distances(query, canidates):
+    query = _sd_clean(query)
+    cur_q = [query] * len(canidates)
+    cur_c = [_sd_clean(c) for c in canidates]
+    base = _grouped_basic_dist(cur_q, cur_c)
+    penalty = np.zeros(len(canidates))
+    for pat, weight in SD_COMPILED:
+        case_q = [_sd_strip(pat, q) for q in cur_q]
+        case_c = [_sd_strip(pat, c) for c in cur_c]
+        changed = [
+            i
+            for i in range(len(canidates))
+            if case_q[i] != cur_q[i] or case_c[i] != cur_c[i]
+        ]
+        if not changed:
+            continue
+        case_dist = _grouped_basic_dist(
+            [case_q[i] for i in changed], [case_c[i] for i in changed]
+        )
+        delta = np.maximum(0.0, base[changed] - case_dist)
+        for i, d, cd in zip(changed, delta, case_dist):
+            if d == 0.0:
+                continue
+            cur_q[i] = case_q[i]
+            cur_c[i] = case_c[i]
+            base[i] = cd
+            penalty[i] += weight * d
+    return base + penalty
+
+
+def _grouped_basic_dist(queries, canidates):
+    "basic distance for paired query/canidate lists, batched by distinct query"
+    out = np.empty(len(canidates))
+    groups = {}
+    for i, q in enumerate(queries):
+        groups.setdefault(q, []).append(i)
+    for q, idx in groups.items():
+        out[idx] = _basic_dist_batch(q, [canidates[i] for i in idx])
+    return out
+
+
+def cache_stats():
+    "CacheInfo for each of the shared normalization and distance caches"
+    return {
+        "normalize": _sd_clean.cache_info(),
+        "transliterate": _sd_basic.cache_info(),
+        "patterns": _sd_strip.cache_info(),
+        "names": normalize_name.cache_info(),
+        "unescape": unescape.cache_info(),
+        "distance": DISTANCES.cache_info(),
+    }
+
+
+def cache_summary():
+    "one line summary of cache hit rates for the end of a run, workers included"
+    parts = []
+    for name, info in cache_stats().items():
+        worker_hits, worker_misses = WORKER_CACHE_COUNTS.get(name, (0, 0))
+        hits = info.hits + worker_hits
+        lookups = hits + info.misses + worker_misses
+        if lookups:
+            parts.append(f"{name} {hits / lookups:.0%} of {lookups}")
+    return ", ".join(parts)
+
+
+def distance_weights(*keys):
+    weights = settings.get().distance_weights
+    return [weights[k] for k in keys]
+
+
+def track_distances(track_info, items, restrict_album=False):
+    """
+    Batch version of track_distance. Returns an array of the weighted distance
+    between track_info and each item, as a beets Distance would calculate it.
+    """
+    w_length, w_title, w_artist, w_album = distance_weights(
+        "track_length", "track_title", "track_artist", "album"
+    )
+    raw = np.zeros(len(items))
+    total = np.zeros(len(items))
+
+    if track_info.length:
+        s = settings.get()
+        grace, length_max = s.track_length_grace, s.track_length_max
+        lengths = np.fromiter((i.length or 0 for i in items), dtype=np.float64)
+        has_length = lengths > 0
+        diff = np.abs(lengths - track_info.length) - grace
+        ratio = np.clip(diff, 0, length_max) / length_max if length_max else 0.0
+        raw += np.where(has_length, w_length * ratio, 0.0)
+        total += np.where(has_length, w_length, 0.0)
+
+    raw += w_title * string_distances(track_info.title, [i.title for i in items])
+    total += w_title
+
+    artist = [i.artist.lower() not in VA_ARTISTS for i in items]
+    if any(artist):
+        dist = string_distances(track_info.artist, [i.artist for i in items])
+        raw += np.where(artist, w_artist * dist, 0.0)
+        total += np.where(artist, w_artist, 0.0)
+
+    if restrict_album and track_info.album:
+        album = [bool(i.album) for i in items]
+        dist = string_distances(track_info.album, [i.album or "" for i in items])
+        raw += np.where(album, w_album * dist, 0.0)
+        total += np.where(album, w_album, 0.0)
+
+    return raw / total
+
+
 def match_artist(track_artist, artists):
-    d = {}
-    for a in artists:
-        dist = beets_tagger.Distance()
-        dist.add_string("artist", track_artist, a)
-        d[dist] = a
-    best = min(d)
-    if best > 0.1:
+    artists = list(artists)
+    if not artists:
         return None
-    return d[best]
+    dists = string_distances(track_artist, artists)
+    best = int(np.argmin(dists))
+    if dists[best] > 0.1:
+        return None
+    return artists[best]
 
 
-def beets_match(track_info, lib, restrict_album=False):
+def length_window(length, restrict_album=False, match_threshold=None):
+    """
+    The (min, max) canidate lengths worth scoring for a track of `length`.
+    Anything outside has a weighted track_length penalty of more than the match
+    threshold (or a distance already found) on its own, so it could never be
+    accepted. Returns None when the length is unknown, the prefilter is disabled
+    or no length rules a match out.
+    """
+    s = settings.get()
+    if not length or not s.length_prefilter:
+        return None
+    if match_threshold is None:
+        match_threshold = s.match_threshold
+    w_length, *others = distance_weights(
+        "track_length", "track_title", "track_artist", "album"
+    )
+    if not restrict_album:
+        others.pop()
+    if not w_length:
+        return None
+    # the length penalty is smallest when every other field is scored too
+    needed = match_threshold * (w_length + sum(others)) / w_length
+    if needed >= 1:
+        return None
+    margin = s.track_length_grace + needed * s.track_length_max
+    return length - margin, length + margin
+
+
+def _in_window(canidate, window):
+    if window is None or not canidate.length:
+        return True
+    return window[0] <= canidate.length <= window[1]
+
+
+def best_canidate(track_info, canidates, match_threshold, restrict_album=False):
+    """
+    return the closest canidate to track_info, or None if none are close enough.
+    Canidates within the length grace are scored first, the closest of them
+    then rules out every canidate whose length penalty alone is larger.
+    """
+    length = track_info.length
+    window = length_window(length, restrict_album, match_threshold)
+    canidates = [c for c in canidates if _in_window(c, window)]
+    if not canidates:
+        return None
+    near = length_window(length, restrict_album, 0)
+    order = [i for i, c in enumerate(canidates) if _in_window(c, near)]
+    dists = track_distances(
+        track_info, [canidates[i] for i in order], restrict_album=restrict_album
+    )
+    if len(order) < len(canidates):
+        bound = min(match_threshold, dists.min(initial=match_threshold))
+        window = length_window(length, restrict_album, bound)
+        scored = set(order)
+        rest = [
+            i for i, c in enumerate(canidates) if i not in scored and _in_window(c, window)
+        ]
+        if rest:
+            more = track_distances(
+                track_info, [canidates[i] for i in rest], restrict_album=restrict_album
+            )
+            dists = np.concatenate([dists, more])
+            order += rest
+    if not order:
+        return None
+    # ties go to the earliest canidate, as if they had all been scored in order
+    best = min(range(len(order)), key=lambda j: (dists[j], order[j]))
+    if dists[best] >= match_threshold:
+        return None
+    return canidates[order[best]]
+
+
+# LibraryIndex used in a match worker process, set by its initializer
+_WORKER_INDEX = None
+
+# cache hits and misses made in match worker processes, name -> [hits, misses]
+WORKER_CACHE_COUNTS = {}
+_worker_counts_lock = threading.Lock()
+
+
+def _init_match_worker(index, worker_settings):
+    global _WORKER_INDEX
+    _WORKER_INDEX = index
+    settings.use(worker_settings)
+
+
+def _cache_counts():
+    return {name: (i.hits, i.misses) for name, i in cache_stats().items()}
+
+
+def _match_chunk(tracks, match_threshold, restrict_album):
+    """
+    worker side of parallel matching -> (an item id or None for each track,
+    the cache hits and misses made doing it)
+    """
+    before = _cache_counts()
+    results = []
+    for t in tracks:
+        best = best_canidate(
+            t,
+            _WORKER_INDEX.candidates(t, restrict_album=restrict_album),
+            match_threshold,
+            restrict_album,
+        )
+        results.append(best.id if best else None)
+    counts = {
+        name: (hits - before[name][0], misses - before[name][1])
+        for name, (hits, misses) in _cache_counts().items()
+    }
+    return results, counts
+
+
+def _add_worker_counts(counts):
+    with _worker_counts_lock:
+        for name, (hits, misses) in counts.items():
+            total = WORKER_CACHE_COUNTS.setdefault(name, [0, 0])
+            total[0] += hits
+            total[1] += misses
+
+
+def match_pool(index, workers):
+    """
+    A process pool for matching against index. Workers are started by a fork
+    server (or spawned) rather than forked from this multithreaded process,
+    and receive the index and settings through their initializer. The index is
+    pickled to every worker once, each keeping its own copy, so reuse the pool.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+    return ProcessPoolExecutor(
+        workers,
+        mp_context=ctx,
+        initializer=_init_match_worker,
+        initargs=(index, settings.get()),
+    )
+
+
+def _parallel_index_match(tracks, pool, match_threshold, restrict_album, workers):
+    size = max(1, math.ceil(len(tracks) / (workers * 4)))
+    shards = list(utils.chunk(tracks, size))
+    ids = []
+    for results, counts in pool.map(
+        _match_chunk,
+        shards,
+        itertools.repeat(match_threshold),
+        itertools.repeat(restrict_album),
+    ):
+        ids.extend(results)
+        _add_worker_counts(counts)
+    return ids
+
+
+def beets_match(
+    track_info, lib, restrict_album=False, index=None, workers=None, pool=None
+):
+    """
+    Match TrackInfos to items in the beets library. If a LibraryIndex is given
+    canidates are drawn from it instead of querying the library for each track,
+    and scoring can be spread over `workers` processes. Pass a match_pool()
+    for the index when calling from a thread other than the main one.
+    """
     original = track_info if isinstance(track_info, dict) else None
     if original:
         track_info = [t for t, v in original.items() if v is None]
-    match_threshold = config["beets_match_threshold"].as_number()
-    matched = {}
+    match_threshold = settings.get().match_threshold
+    ordered = []
+    tracks = {}  # key -> TrackInfo, the same song more than once is matched once
     for t in track_info:
         if not isinstance(t, TrackInfo):
             log.debug("%s is not a TrackInfo object, skipping.", t)
             continue
-        res = list(lib.items(shlex.quote("title:" + t.title)))
-        if not res and t.album:
-            res.extend(lib.items(shlex.quote("album:" + t.album)))
-        if not res and t.artist:
-            res.extend(lib.items(shlex.quote("artist:" + t.artist)))
-        if not res:
-            matched[t] = None
-            continue
+        ordered.append(t)
+        tracks.setdefault(t.key, t)
+    tracks = list(tracks.values())
+    results = {}  # key -> item
+
+    if index is not None and workers and workers > 1 and len(tracks) > 1:
+        log.debug("Matching %d tracks with %d workers.", len(tracks), workers)
+        if pool is None:
+            with match_pool(index, workers) as pool:
+                ids = _parallel_index_match(
+                    tracks, pool, match_threshold, restrict_album, workers
+                )
         else:
-            canidates = {
-                track_distance(r, t, restrict_album=restrict_album): r for r in res
-            }
+            ids = _parallel_index_match(
+                tracks, pool, match_threshold, restrict_album, workers
+            )
+        for t, item_id in zip(tracks, ids):
+            results[t.key] = lib.get_item(item_id) if item_id is not None else None
+        tracks = []
 
-        best = min(canidates)
-        if best >= match_threshold:
-            matched[t] = None
+    for t in tracks:
+        if index is not None:
+            res = index.candidates(t, restrict_album=restrict_album)
         else:
-            matched[t] = canidates[best]
+            res = list(lib.items(shlex.quote("title:" + t.title)))
+            if not res and t.album:
+                res.extend(lib.items(shlex.quote("album:" + t.album)))
+            if not res and t.artist:
+                res.extend(lib.items(shlex.quote("artist:" + t.artist)))
+        best = best_canidate(t, res, match_threshold, restrict_album)
+        if best is not None and index is not None:
+            best = lib.get_item(best.id)
+        results[t.key] = best
+    # every playlist position keeps its own entry
+    matched = {t: results[t.key] for t in ordered}
     if original:
         original.update(matched)
         matched = original
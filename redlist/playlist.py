@@ -4,14 +4,20 @@ import re
 from pathlib import Path
 import shlex
 
+from beets import util as beets_util
+from beets.dbcore.query import MatchQuery, OrQuery
 from mutagen.easyid3 import EasyID3
 
 from .matching import TrackInfo, track_distance, beets_match
 from . import spotify
 from . import config
+from . import utils
 
 log = logging.getLogger(__name__)
 
+# Paths per library query, keeps the OR expression under SQLite's depth limit
+PATH_QUERY_CHUNK = 500
+
 
 def spotlist_to_m3u(spotlist, music_dir):
     music_dir = Path(music_dir)
@@ -42,30 +48,62 @@ def get_sp_data(spotlist):
     return tracks
 
 
+def render_m3u(track_infos, url=None):
+    "From a mapping of TrackInfo -> beetsLibraryItems, return the m3u file contents"
+    lines = []
+    if url:
+        lines.append("# {}".format(url).encode("utf8"))
+    for track, item in track_infos.items():
+        try:
+            lines.append(item.path)
+        except AttributeError:
+            if isinstance(track, str):
+                lines.append(track.encode("utf8"))
+            elif isinstance(track, TrackInfo):
+                lines.append(
+                    b"# TrackInfo(json='''%s''')" % track.json().encode("utf8")
+                )
+            else:
+                lines.append(b"")
+    return b"".join(l + b"\n" for l in lines)
+
+
 def create_m3u_from_info(track_infos, output: Path, url=None):
     "From a mapping of TrackInfo -> beetsLibraryItems, create a m3u playlist"
     log.info("Writing m3u file to %s.", output)
     with open(output, "wb") as fout:
-        if url:
-            fout.write("# {}\n".format(url).encode("utf8"))
-        for track, item in track_infos.items():
-            try:
-                fout.write(item.path)
-            except AttributeError:
-                if isinstance(track, str):
-                    fout.write(track.encode("utf8"))
-                elif isinstance(track, TrackInfo):
-                    fout.write(
-                        b"# TrackInfo(json='''%s''')" % track.json().encode("utf8")
-                    )
-            fout.write(b"\n")
+        fout.write(render_m3u(track_infos, url))
+
+
+def items_by_path(lib, paths):
+    "Resolve many paths to library items with a few bulk queries -> {path: item}"
+    wanted = {}
+    for p in paths:
+        wanted.setdefault(beets_util.normpath(p), p)
+    found = {}
+    for chunk in utils.chunk(wanted, PATH_QUERY_CHUNK):
+        query = OrQuery([MatchQuery("path", p) for p in chunk])
+        for item in lib.items(query):
+            found[item.path] = item
+    resolved = {wanted[p]: found[p] for p in wanted if p in found}
+    # paths that are not stored verbatim (ie case insensitive filesystems)
+    # still get beets' full path matching
+    for p in wanted.values():
+        if p not in resolved:
+            item = lib.items(shlex.quote("path:" + p)).get()
+            if item is not None:
+                resolved[p] = item
+    return resolved
 
 
 def create_info_from_m3u(m3u: Path, lib):
     "Given an m3u, track_info:beets_match dictionary"
     m3u = Path(m3u)
+    lines = m3u.read_text().splitlines()
+    items = items_by_path(lib, (l for l in lines if not l.startswith("#")))
     matches = OrderedDict()
-    for line in m3u.read_text().splitlines():
+    missing = []
+    for line in lines:
         if line.startswith("# TrackInfo"):
             info = parse_track_info_string(line)
             matches[info] = None
@@ -73,16 +111,27 @@ def create_info_from_m3u(m3u: Path, lib):
             matches[line] = None
             continue
         else:
-            item = lib.items(shlex.quote("path:" + line)).get()
+            item = items.get(line)
             if item is None:
-                log.error("Could not find item at path %s", line)
+                missing.append(line)
                 continue
+            if item in matches:  # the same file more than once
+                item = item.copy()
             matches[item] = item
+    if missing:
+        log.error(
+            "Could not find %d items in the beets library:\n\t%s",
+            len(missing),
+            "\n\t".join(missing),
+        )
     return matches
 
 
 async def parse_playlist(argument, library):
-    "Given a path or spotify uri return playlist_name, track_info"
+    """
+    Given a path or spotify uri return playlist_name, track_info
+    library is an AsyncLibrary, m3u files are resolved on its thread pool.
+    """
     spotify_id = parse_spotfiy_id(argument)
     if spotify_id:
         log.info("Fetching playlist %s from spotify.", spotify_id)
@@ -93,18 +142,61 @@ async def parse_playlist(argument, library):
         raise FileNotFoundError(f)
     if f.suffix in [".m3u", ".m3u8"]:
         log.info("Reading in m3u file %s.", f.stem)
-        return f.stem, create_info_from_m3u(f, lib=library)
+        return f.stem, await library.run(create_info_from_m3u, f, library.lib)
     log.info("Reading in csv file %s.", f.stem)
     return f.stem, get_sp_data(f)
 
 
-async def make_missing_spotify_playlist(title, trackinfos):
+def _spotify_status(e):
+    "the http status of a SpotifyError, None for other exceptions"
+    try:
+        return e.json["error"]["status"]
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+def _log_spotify_error(e):
+    if _spotify_status(e) == 403:
+        token_file = Path(config.config_dir()) / "spotify_token.json"
+        log.error(
+            (
+                "[RED]list does not have sufficient permissions."
+                " Try deleting %s to reauthorize"
+            ),
+            token_file,
+        )
+
+
+async def make_missing_spotify_playlist(title, trackinfos, playlist_id=None):
+    """
+    Fill a spotify playlist with the missing tracks and return its id.
+    If playlist_id is given that playlist is updated with only the changes,
+    otherwise (or if it no longer exists) a new playlist is created.
+    """
     try:
         assert all(hasattr(t, "spotify_id") for t in trackinfos)
     except AssertionError:
         log.error("Not all tracks have a spotify id, cannot create a spotify playlist.")
-        return
-    ids = (t.spotify_id for t in trackinfos)
+        return playlist_id
+    ids = [t.spotify_id for t in trackinfos]
+    if playlist_id:
+        try:
+            added, removed = await spotify.update_playlist(playlist_id, ids)
+        except Exception as e:
+            if _spotify_status(e) != 404:
+                log.error("Could not update spotify playlist!")
+                log.debug("Stack Trace:", exc_info=True)
+                _log_spotify_error(e)
+                return playlist_id
+            if not ids:
+                return None
+            log.info("Missing tracks playlist %s is gone, recreating it.", playlist_id)
+        else:
+            print(
+                f"updated playlist of missing tracks (+{len(added)} -{len(removed)}) at : "
+                f"https://open.spotify.com/playlist/{playlist_id}"
+            )
+            return playlist_id
     description = (
         f"A playlist of songs from the {title} playlist "
         "that you do not have in your beets library."
@@ -116,23 +208,16 @@ async def make_missing_spotify_playlist(title, trackinfos):
     except Exception as e:
         log.error("Could not create spotify playlist!")
         log.debug("Stack Trace:", exc_info=True)
-        if isinstance(e, spotify.SpotifyError):
-            try:
-                if e.json["error"]["status"] == 403:
-                    token_file = Path(config.config_dir()) / "spotify_token.json"
-                    log.error(
-                        (
-                            "[RED]list does not have sufficient permissions."
-                            " Try deleting %s to reauthorize"
-                        ),
-                        token_file,
-                    )
-            except KeyError:
-                pass
-        return
+        _log_spotify_error(e)
+        return None
     print(
         f"created playlist of missing tracks at : https://open.spotify.com/playlist/{location}"
     )
+    return location
+
+
+def is_m3u(argument):
+    return bool(re.match(r".*\.(m3u|m3u8)$", argument))
 
 
 def parse_spotfiy_id(address):
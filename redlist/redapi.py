@@ -148,6 +148,7 @@ class RedAPI:
         self.passkey = None
         self.host = host
         self.fl_bucket = TokenBucket(1, 1 / 70)
+        self.fl_tokens_used = 0  # by every playlist handled with this session
 
     async def _auth(self):
         "Get authkey from server, must always be done after login or first connection"
@@ -207,7 +208,10 @@ class RedAPI:
                 r'filename="(.+)"', response.headers["content-disposition"]
             )
             filename = match.group(1)
-            return filename, await response.content.read()
+            data = await response.content.read()
+        if use_fl:
+            self.fl_tokens_used += 1
+        return filename, data
 
     async def request(self, action, **kwargs):
         "Make an AJAX request for a given action"
@@ -1,12 +1,10 @@
 import re
 import logging
-import html
-
-from beets.autotag import distance as beets_tagger
+import functools
 
 from .redapi import get_api
 from . import matching
-from . import config
+from . import settings
 
 log = logging.getLogger(__name__)
 log.setLevel("INFO")
@@ -42,10 +40,7 @@ async def find_album(track_info, restrict_album=True):
     if len(res["results"]) == 1:
         log.info("Hit on first try for %s.", track_info)
         group = res["results"][0]
-        prefs = [
-            re.compile(p, re.I) for p in config["redacted"]["format_preferences"].get()
-        ]
-        prefered = choose_prefered_torrent(group, prefs)
+        prefered = choose_prefered_torrent(group, settings.get().format_ranker)
         if prefered is None:
             log.info(
                 "Could not find a torrent for %s that fits your current preferences.",
@@ -53,7 +48,7 @@ async def find_album(track_info, restrict_album=True):
             )
         del group["torrents"]
         group["torrent"] = prefered
-        group["groupName"] = html.unescape(group["groupName"])
+        group["groupName"] = matching.unescape(group["groupName"])
         return group
     elif len(res["results"]) > 1:
         log.info(
@@ -111,16 +106,25 @@ async def search_torrent_groups(track_info, torrent_groups, api, restrict_album=
     "search list of torrent groups for a given track and return a torrent for it"
     group_canidates = {}
     # score them by how likely they are to match the given track
+    artist_matched = []
     for index, group in enumerate(torrent_groups):
-        group["groupName"] = html.unescape(group["groupName"])  # clean album html
+        group["groupName"] = matching.unescape(group["groupName"])  # clean album html
         group_artist = matching.match_artist(track_info.artist, get_artists(group))
         group["artist_match"] = group_artist
-        if not group_artist:
-            continue
-        dist = beets_tagger.Distance()
-        dist.add_string("artist", track_info.artist, group_artist)
-        if track_info.album:
-            dist.add_string("album", track_info.album, group["groupName"])
+        if group_artist:
+            artist_matched.append(index)
+    groups = [torrent_groups[i] for i in artist_matched]
+    w_artist, w_album = matching.distance_weights("artist", "album")
+    raw = w_artist * matching.string_distances(
+        track_info.artist, [g["artist_match"] for g in groups]
+    )
+    total = w_artist
+    if track_info.album:
+        raw += w_album * matching.string_distances(
+            track_info.album, [g["groupName"] for g in groups]
+        )
+        total += w_album
+    for index, group, dist in zip(artist_matched, groups, raw / total):
         if dist > 0.5:
             log.info(
                 "distance of %f is too high for %s, skipping to next",
@@ -131,12 +135,10 @@ async def search_torrent_groups(track_info, torrent_groups, api, restrict_album=
         group_canidates[index] = dist
     # Search files of each torrentGroup in descending likelyhood and return
     # first to be a good match
-    prefs = [
-        re.compile(p, re.I) for p in config["redacted"]["format_preferences"].get()
-    ]
+    ranker = settings.get().format_ranker
     for group in sorted(group_canidates, key=lambda g: group_canidates[g]):
         group = torrent_groups[group]
-        prefered = choose_prefered_torrent(group, prefs)
+        prefered = choose_prefered_torrent(group, ranker)
         if prefered is None:
             log.info(
                 "Could not find a torrent for %s that fits your current prefrences",
@@ -152,6 +154,11 @@ async def search_torrent_groups(track_info, torrent_groups, api, restrict_album=
         full_torrent_data = await api.request("torrent", id=prefered["torrentId"])
         full_torrent_data = full_torrent_data["response"]
         torrent_data = full_torrent_data["torrent"]
+        # lets the download step recognise torrents that are already loaded
+        for key in ("infoHash", "filePath"):
+            if torrent_data.get(key):
+                prefered[key] = torrent_data[key]
+        canidate_infos = []
         for track_canidate in torrent_data["fileList"].split("|||"):
             original_canidate = track_canidate
             match = re.match(
@@ -185,61 +192,101 @@ async def search_torrent_groups(track_info, torrent_groups, api, restrict_album=
                     prefered["torrentId"],
                 )
                 continue
+            canidate_infos.append(canidate_info)
 
-            dist = matching.track_distance(
-                track_info, canidate_info, restrict_album=restrict_album
+        if not canidate_infos:
+            continue
+        dists = matching.track_distances(
+            track_info, canidate_infos, restrict_album=restrict_album
+        )
+        best = int(dists.argmin())
+        if dists[best] <= 0.3:
+            log.info(
+                'Found torrent for "%s" with %.1f%% confidence.',
+                track_info,
+                (1 - dists[best]) * 100,
             )
-            if dist <= 0.3:
-                log.info(
-                    'Found torrent for "%s" with %.1f%% confidence.',
-                    track_info,
-                    (1 - dist) * 100,
-                )
-                group["torrent"] = prefered
-                del group["torrents"]
-                return group
+            group["torrent"] = prefered
+            del group["torrents"]
+            return group
     log.info("Unable to find torrent for %s", track_info)
     return None
 
 
 def get_artists(torrent_group):
     "get a set of artists from a torrent_group"
-    artists = {torrent_group["artist"].lower()}
+    artists = {matching.normalize_name(torrent_group["artist"])}
     for t in torrent_group["torrents"]:
         for a in t["artists"]:
-            artists.add(a["name"].lower())
+            artists.add(matching.normalize_name(a["name"]))
     try:
         for key, art in torrent_group["musicInfo"].items():
             for a in art:
-                artists.add(a["name"].lower())
+                artists.add(matching.normalize_name(a["name"]))
     except KeyError:
         pass
     return artists - set(matching.VA_ARTISTS)
 
 
-def choose_prefered_torrent(torrent_group, prefs):
-    ordering = []
-    for t in torrent_group["torrents"]:
-        tmp = []
+class FormatRanker:
+    """
+    Orders torrents by the format preferences, then by `keys`, torrent fields
+    to break ties on. Prefix a key with "-" to prefer larger values, ie:
+    ("-seeders", "size"). The preference rank of each distinct
+    (format, encoding, media) is only worked out once.
+    """
+
+    def __init__(self, prefs, keys=("-snatches", "-seeders")):
+        self.prefs = tuple(
+            re.compile(p, re.I) if isinstance(p, str) else p for p in prefs
+        )
+        self.keys = tuple((k.lstrip("-"), -1 if k.startswith("-") else 1) for k in keys)
+        self.format_rank = functools.lru_cache(maxsize=4096)(self._format_rank)
+
+    def _format_rank(self, fmt, encoding, media):
+        """
+        A bitmask of the preferences the format does not match, earliest
+        preference in the highest bit. Smaller is better.
+        """
+        value = " ".join((fmt, encoding, media))
+        rank = 0
+        for p in self.prefs:
+            rank = rank << 1 | (p.match(value) is None)
+        return rank
+
+    def key(self, torrent):
+        "a sort key for a torrent, smaller is better. None if it has no format"
         try:
-            fmt = " ".join(t[k] for k in ["format", "encoding", "media"])
+            rank = self.format_rank(
+                torrent["format"], torrent["encoding"], torrent["media"]
+            )
         except KeyError:
-            continue
-        tmp.append(get_priority_tuple(fmt, prefs))
-        tmp.append(-t["snatches"])
-        tmp.append(-t["seeders"])
-        ordering.append((tuple(tmp), t))
-    try:
-        return min(ordering, key=lambda x: x[0])[1]
-    except ValueError:
-        return None
-
-
-def get_priority_tuple(value, prefs):
-    tmp = []
-    for p in prefs:
-        if p.match(value):
-            tmp.append(0)
-        else:
-            tmp.append(1)
-    return tuple(tmp)
+            return None
+        return (rank,) + tuple(sign * (torrent.get(k) or 0) for k, sign in self.keys)
+
+    def rank(self, torrents):
+        "torrents with a known format, best first"
+        keyed = [(self.key(t), i, t) for i, t in enumerate(torrents)]
+        return [t for k, _, t in sorted(x for x in keyed if x[0] is not None)]
+
+    def choose(self, torrent_group):
+        "the best torrent in a torrent group, or None"
+        best = None
+        for t in torrent_group["torrents"]:
+            k = self.key(t)
+            if k is not None and (best is None or k < best[0]):
+                best = (k, t)
+        return best[1] if best else None
+
+
+@functools.lru_cache(maxsize=32)
+def get_ranker(prefs, keys=("-snatches", "-seeders")):
+    "a shared FormatRanker for a tuple of preferences and keys"
+    return FormatRanker(prefs, keys)
+
+
+def choose_prefered_torrent(torrent_group, prefs):
+    "prefs may be a FormatRanker or a list of preference patterns"
+    if not isinstance(prefs, FormatRanker):
+        prefs = get_ranker(tuple(prefs))
+    return prefs.choose(torrent_group)
@@ -0,0 +1,90 @@
+import re
+import logging
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping, Pattern, Tuple
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+WEIGHT_KEYS = ("track_length", "track_title", "track_artist", "album", "artist")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    The configuration values read by the matching and searching hot paths,
+    resolved once so per canidate loops never go through confuse.
+    """
+
+    format_preferences: Tuple[Pattern, ...] = ()
+    rank_by: Tuple[str, ...] = ("-snatches", "-seeders")
+    restrict_album: bool = False
+    match_threshold: float = 0.3
+    length_prefilter: bool = True
+    track_length_grace: float = 10.0
+    track_length_max: float = 30.0
+    distance_weights: Mapping[str, float] = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls):
+        from beets import config as beetconfig
+        from . import matching  # noqa: F401, applies redlist's beets weights
+
+        match = beetconfig["match"]
+        weights = match["distance_weights"]
+        return cls(
+            format_preferences=tuple(
+                re.compile(p, re.I)
+                for p in config["redacted"]["format_preferences"].get()
+            ),
+            rank_by=tuple(config["redacted"]["rank_by"].as_str_seq()),
+            restrict_album=bool(config["restrict_album"].get()),
+            match_threshold=config["beets_match_threshold"].as_number(),
+            length_prefilter=bool(config["length_prefilter"].get()),
+            track_length_grace=match["track_length_grace"].as_number(),
+            track_length_max=match["track_length_max"].as_number(),
+            distance_weights=MappingProxyType(
+                {k: weights[k].as_number() for k in WEIGHT_KEYS}
+            ),
+        )
+
+    @property
+    def format_ranker(self):
+        "the shared redsearch.FormatRanker for these preferences"
+        from .redsearch import get_ranker
+
+        return get_ranker(self.format_preferences, self.rank_by)
+
+    def __reduce__(self):
+        # MappingProxyType can't be pickled, send a plain dict to match workers
+        values = {**self.__dict__, "distance_weights": dict(self.distance_weights)}
+        return (_rebuild, (values,))
+
+
+def _rebuild(values):
+    values["distance_weights"] = MappingProxyType(values["distance_weights"])
+    return Settings(**values)
+
+
+SETTINGS = None
+
+
+def load():
+    "Build the settings from the current configuration, call after config.set_args"
+    global SETTINGS
+    SETTINGS = Settings.from_config()
+    log.debug("Loaded settings: %s", SETTINGS)
+    return SETTINGS
+
+
+def use(settings):
+    "Use an already built Settings, ie: in a worker process"
+    global SETTINGS
+    SETTINGS = settings
+
+
+def get():
+    "The current Settings, built from the configuration on first use"
+    return SETTINGS if SETTINGS is not None else load()
@@ -6,8 +6,9 @@ import json
 import logging
 import re
 import pprint
-from cryptography import fernet
+import functools
 from urllib.parse import urlencode
+from collections import namedtuple
 from pathlib import Path
 import os
 
@@ -26,12 +27,25 @@ CODE = (
     b"B-BhFGuD0dXAHvJRBMpbyR1m6KfedbSoFh4n9AKt5uY8yoAx3BeoPlFqVR3I3Exfbn5vUP9jAH7jamecRMSSPc"
     b"Y-yL5iZyQ_5rrkOUZ2ls="
 )
-frn = fernet.Fernet(KEY)
-AUTH_HEADER = frn.decrypt(CODE)
-CLIENT_ID, _ = AUTH_HEADER.split(b":")
-AUTH_HEADER = {
-    "Authorization": "Basic " + base64.b64encode(AUTH_HEADER).decode("ascii")
-}
+
+
+@functools.lru_cache(maxsize=None)
+def client_credentials():
+    "decrypt the app credentials on first use -> (client id, auth header)"
+    from cryptography import fernet
+
+    credentials = fernet.Fernet(KEY).decrypt(CODE)
+    client_id, _ = credentials.split(b":")
+    auth_header = {
+        "Authorization": "Basic " + base64.b64encode(credentials).decode("ascii")
+    }
+    return client_id, auth_header
+
+
+# Only request what TrackInfo.from_spotify reads
+TRACK_FIELDS = "track(name,id,duration_ms,artists(name),album(name))"
+PAGE_FIELDS = f"total,limit,items({TRACK_FIELDS})"
+PLAYLIST_FIELDS = f"name,snapshot_id,tracks({PAGE_FIELDS})"
 AUTH_URL = "https://accounts.spotify.com/authorize"
 TOKEN_URL = "https://accounts.spotify.com/api/token"
 
@@ -42,135 +56,355 @@ class SpotifyError(Exception):
         super().__init__(args)
 
 
-async def fetch_play_list_data(playlist_id, token=None):
-    "given a uri or playlist id, return a list of TrackInfo objects"
-    if token is None:
-        token = SpotifyAccessToken()
-        await token.ensure_valid()
+Response = namedtuple("Response", "status headers json")
 
-    url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
-    data = {"next": url}
-    name = playlist_id
-    tracks = []
-    async with aiohttp.ClientSession(headers=token.auth_header) as session:
-        while data["next"]:
-            async with session.get(data["next"]) as resp:
-                if resp.status == 429:  # Rate limit exceded
-                    await asyncio.sleep(resp.headers["Retry-After"] + 1)
-                    continue
-                json = await resp.json()
-            try:  # First iteration
-                data = json["tracks"]
-                name = json["name"]
-            except KeyError:  # more than 100 data
-                log.debug("Fetching more playlist tracks from Spotify.")
-                data = json
+
+def retry_after(resp):
+    "seconds to wait before retrying a rate limited response"
+    try:
+        return int(resp.headers["Retry-After"]) + 1
+    except (KeyError, ValueError):
+        return 5
+
+
+class SpotifyClient:
+    """
+    One pooled session and in memory access token shared by all spotify requests.
+    The token is refreshed in the background before it expires.
+    Should not be instantiated directly; instead use get_client()
+    """
+
+    REFRESH_MARGIN = 300  # seconds before expiry to refresh the token
+
+    def __init__(self, token=None, concurrency=None):
+        self.token = token if token is not None else SpotifyAccessToken()
+        if concurrency is None:
+            concurrency = config["spotify"]["concurrency"].get(int)
+        self._session = None
+        self._token_lock = asyncio.Lock()
+        self._refresher = None
+        self._limit = asyncio.Semaphore(max(1, concurrency))
+        self._resume_at = 0  # time.monotonic() when rate limiting ends
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def ensure_token(self):
+        if not self.token.is_valid:
+            async with self._token_lock:
+                await self.token.ensure_valid()
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.ensure_future(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            expires_at = self.token.token_info["expires_at"]
+            await asyncio.sleep(max(expires_at - time.time() - self.REFRESH_MARGIN, 0))
             try:
-                tracks.extend(
-                    matching.TrackInfo.from_spotify(t)
-                    for t in data["items"]
-                    if t["track"] is not None
+                async with self._token_lock:
+                    await self.token.refresh()
+            except (aiohttp.ClientError, KeyError):
+                log.debug("Background spotify token refresh failed.", exc_info=True)
+                await asyncio.sleep(30)
+
+    async def _backoff(self):
+        "wait until any rate limiting seen by another request has passed"
+        while True:
+            wait = self._resume_at - time.monotonic()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def request(self, method, url, headers=None, **kwargs):
+        """
+        make an authorized request -> Response
+        At most spotify.concurrency requests run at once, and a rate limited
+        response pauses every request until Retry-After has passed.
+        """
+        await self.ensure_token()
+        headers = {**(headers or {}), **self.token.auth_header}
+        async with self._limit:
+            while True:
+                await self._backoff()
+                async with self.session.request(
+                    method, url, headers=headers, **kwargs
+                ) as resp:
+                    if resp.status == 429:  # Rate limit exceded
+                        wait = retry_after(resp)
+                        log.debug("Rate limit exceded, waiting %d seconds...", wait)
+                        self._resume_at = max(self._resume_at, time.monotonic() + wait)
+                        continue
+                    json = None if resp.status == 304 else await resp.json()
+                    return Response(resp.status, resp.headers, json)
+
+    async def get_json(self, url, params=None):
+        resp = await self.request("GET", url, params=params)
+        return resp.json
+
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+
+CLIENT = None
+
+
+def get_client():
+    "Return the shared SpotifyClient"
+    global CLIENT
+    if CLIENT is None:
+        CLIENT = SpotifyClient()
+    return CLIENT
+
+
+async def close_client():
+    global CLIENT
+    if CLIENT is not None:
+        await CLIENT.close()
+        CLIENT = None
+
+
+def _parse_page(items):
+    try:
+        return [
+            matching.TrackInfo.from_spotify(t) for t in items if t["track"] is not None
+        ]
+    except matching.MatchingError as e:
+        pprint.pprint(e.data)
+        raise
+
+
+async def _fetch_playlist(playlist_id, client):
+    """
+    given a playlist id -> (name, snapshot_id, [TrackInfo])
+    Pages after the first are fetched concurrently, up to spotify.concurrency.
+    """
+    url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
+    json = await client.get_json(url, {"fields": PLAYLIST_FIELDS})
+    first = json["tracks"]
+    limit = first["limit"] or 100
+
+    async def fetch_page(offset):
+        log.debug("Fetching playlist tracks %d from Spotify.", offset)
+        params = {"offset": offset, "limit": limit, "fields": PAGE_FIELDS}
+        json = await client.get_json(f"{url}/tracks", params)
+        return _parse_page(json["items"])
+
+    pages = [
+        asyncio.ensure_future(fetch_page(offset))
+        for offset in range(limit, first["total"], limit)
+    ]
+    try:
+        tracks = _parse_page(first["items"])
+        for page in await asyncio.gather(*pages):
+            tracks.extend(page)
+    finally:
+        for page in pages:
+            page.cancel()
+    return json["name"], json["snapshot_id"], tracks
+
+
+def _cache_path(playlist_id):
+    return Path(config.config_dir()) / "spotify_cache" / f"{playlist_id}.json"
+
+
+def load_cached_playlist(playlist_id):
+    "return the cached {snapshot_id, etag, name, tracks} for a playlist, or None"
+    if not config["spotify"]["cache"].get():
+        return None
+    try:
+        with open(_cache_path(playlist_id)) as fin:
+            cached = json.load(fin)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        log.debug("No cached copy of playlist %s: %s", playlist_id, e)
+        return None
+    cached["tracks"] = [matching.TrackInfo(json=t) for t in cached["tracks"]]
+    return cached
+
+
+def save_cached_playlist(playlist_id, snapshot_id, etag, name, tracks):
+    if not config["spotify"]["cache"].get():
+        return
+    path = _cache_path(playlist_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {
+        "snapshot_id": snapshot_id,
+        "etag": etag,
+        "name": name,
+        "tracks": [t.json() for t in tracks],
+    }
+    with open(path, "w") as fout:
+        json.dump(data, fout)
+    log.debug("Cached playlist %s to %s", playlist_id, path)
+
+
+async def _fetch_snapshot(playlist_id, client, cached):
+    "-> (snapshot_id, etag), a conditional request when there is a cached copy"
+    url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    resp = await client.request(
+        "GET", url, params={"fields": "snapshot_id"}, headers=headers
+    )
+    if resp.status == 304:
+        return cached["snapshot_id"], cached["etag"]
+    return resp.json["snapshot_id"], resp.headers.get("ETag")
+
+
+async def fetch_play_list_data(playlist_id, client=None):
+    """
+    given a uri or playlist id, return a list of TrackInfo objects
+    Served from the local cache when the playlist's snapshot_id has not changed.
+    """
+    client = client or get_client()
+    cached = load_cached_playlist(playlist_id)
+    etag = None
+    if cached:
+        snapshot_id, etag = await _fetch_snapshot(playlist_id, client, cached)
+        if cached["snapshot_id"] == snapshot_id:
+            log.debug("Playlist %s is unchanged, using cached tracks.", playlist_id)
+            if etag != cached["etag"]:
+                save_cached_playlist(
+                    playlist_id, snapshot_id, etag, cached["name"], cached["tracks"]
                 )
-            except matching.MatchingError as e:
-                pprint.pprint(e.data)
-                raise
-            log.debug("%s tracks Fetched from playlist.", len(tracks))
+            return cached["name"], cached["tracks"]
+
+    name, snapshot_id, tracks = await _fetch_playlist(playlist_id, client)
     name = re.sub(r"[\\/]", "_", name)
     name = sanitize_path(name)
+    save_cached_playlist(playlist_id, snapshot_id, etag, name, tracks)
     return name, tracks
 
 
-async def fetch_track_data(*ids, token=None):
-    "Get track data from given spotify trackids"
-    if token is None:
-        token = SpotifyAccessToken()
-        await token.ensure_valid()
+async def fetch_snapshot_id(playlist_id, client=None):
+    "get the current snapshot_id of a playlist, changes whenever the playlist does"
+    client = client or get_client()
+    snapshot_id, _ = await _fetch_snapshot(
+        playlist_id, client, load_cached_playlist(playlist_id)
+    )
+    return snapshot_id
 
+
+async def fetch_track_data(*ids, client=None):
+    "Get track data from given spotify trackids"
+    client = client or get_client()
     url = "https://api.spotify.com/v1/tracks"
-    data = []
-    async with aiohttp.ClientSession(headers=token.auth_header) as session:
-        for tracks in utils.chunk(ids, 50):
-            params = {"ids": ",".join(tracks)}
-            while True:
-                async with session.get(url, params=params) as resp:
-                    if resp.status == 429:
-                        log.debug("Rate limit exceded, waiting...")
-                        await asyncio.sleep(resp.headers["Retry-After"] + 1)
-                        continue
-                    json = await resp.json()
-                    data.extend(json["tracks"])
-                    break
-    return data
+    chunks = await asyncio.gather(
+        *(
+            client.get_json(url, {"ids": ",".join(tracks)})
+            for tracks in utils.chunk(ids, 50)
+        )
+    )
+    return [track for json in chunks for track in json["tracks"]]
 
 
-async def create_new_playlist(title, ids, description=None, token=None):
+async def create_new_playlist(title, ids, description=None, client=None):
     'create a new playlist with "title" containing the the track ids'
-    if token is None:
-        token = SpotifyAccessToken()
-        await token.ensure_valid()
-
-    user_id = await get_user_id()
+    client = client or get_client()
+    user_id = await get_user_id(client)
     url = f"https://api.spotify.com/v1/users/{user_id}/playlists"
-    async with aiohttp.ClientSession(headers=token.auth_header) as session:
-        params = {"user_id": user_id, "Content-Type": "application/json"}
-        data = {
-            "name": title,
-            "public": False,
-        }
-        if description:
-            data["description"] = description
-        async with session.post(url, params=params, json=data) as resp:
-            json = await resp.json()
-            if resp.status not in (201, 200):
-                log.debug("Couldn't create playlist")
-                log.debug("Spotify response: %s", json)
-                raise SpotifyError(json=json)
-            playlist_id = json["id"]
-            log.debug("Created new spotify playlist with id %s", playlist_id)
-            log.debug("Full response:")
-            log.debug(json)
-
-        url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-        params = {"Content-Type": "application/json"}
-        for tracks in utils.chunk(ids, 100):
-            uris = [f"spotify:track:{i}" for i in tracks]
-            data = {"uris": uris}
-            while True:
-                async with session.post(url, params=params, json=data) as resp:
-                    if resp.status == 429:
-                        log.debug("Rate limit exceded, waiting...")
-                        await asyncio.sleep(resp.headers["Retry-After"] + 1)
-                        continue
-                    if resp.status != 201:
-                        log.debug("Unexpected response code: %d", resp.status)
-                        json = await resp.json()
-                        log.debug("Response body: %s", json)
-                        raise SpotifyError(json=json)
-                    break
+    params = {"user_id": user_id, "Content-Type": "application/json"}
+    data = {
+        "name": title,
+        "public": False,
+    }
+    if description:
+        data["description"] = description
+    resp = await client.request("POST", url, params=params, json=data)
+    if resp.status not in (201, 200):
+        log.debug("Couldn't create playlist")
+        log.debug("Spotify response: %s", resp.json)
+        raise SpotifyError(json=resp.json)
+    playlist_id = resp.json["id"]
+    log.debug("Created new spotify playlist with id %s", playlist_id)
+    log.debug("Full response:")
+    log.debug(resp.json)
+
+    await add_playlist_tracks(playlist_id, ids, client)
     return playlist_id
 
 
-async def get_user_id(token=None):
+async def _edit_playlist_tracks(method, playlist_id, data, client):
+    url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+    params = {"Content-Type": "application/json"}
+    resp = await client.request(method, url, params=params, json=data)
+    if resp.status not in (200, 201):
+        log.debug("Unexpected response code: %d", resp.status)
+        log.debug("Response body: %s", resp.json)
+        raise SpotifyError(json=resp.json)
+
+
+async def add_playlist_tracks(playlist_id, ids, client=None):
+    "append the track ids to a playlist, 100 per request"
+    client = client or get_client()
+    for tracks in utils.chunk(ids, 100):
+        uris = [f"spotify:track:{i}" for i in tracks]
+        await _edit_playlist_tracks("POST", playlist_id, {"uris": uris}, client)
+
+
+async def remove_playlist_tracks(playlist_id, ids, client=None):
+    "remove every occurence of the track ids from a playlist, 100 per request"
+    client = client or get_client()
+    for tracks in utils.chunk(ids, 100):
+        data = {"tracks": [{"uri": f"spotify:track:{i}"} for i in tracks]}
+        await _edit_playlist_tracks("DELETE", playlist_id, data, client)
+
+
+async def fetch_playlist_track_ids(playlist_id, client=None):
+    "return the track ids in a playlist, raises SpotifyError if it doesn't exist"
+    client = client or get_client()
+    url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+    params = {"offset": 0, "limit": 100, "fields": "total,items(track(id))"}
+    ids = []
+    while True:
+        resp = await client.request("GET", url, params=params)
+        if resp.status != 200:
+            raise SpotifyError(json=resp.json)
+        # local files and unavailable tracks have no id and can't be removed
+        tracks = (t["track"] for t in resp.json["items"])
+        ids.extend(t["id"] for t in tracks if t and t["id"])
+        params["offset"] += params["limit"]
+        if params["offset"] >= resp.json["total"]:
+            return ids
+
+
+async def update_playlist(playlist_id, ids, client=None):
+    """
+    make a playlist contain the track ids, only sending the tracks that were
+    added or removed -> (added, removed)
+    """
+    client = client or get_client()
+    current = set(await fetch_playlist_track_ids(playlist_id, client))
+    wanted = dict.fromkeys(ids)
+    removed = [i for i in current if i not in wanted]
+    added = [i for i in wanted if i not in current]
+    await remove_playlist_tracks(playlist_id, removed, client)
+    await add_playlist_tracks(playlist_id, added, client)
+    log.debug(
+        "Updated playlist %s, %d added, %d removed.",
+        playlist_id,
+        len(added),
+        len(removed),
+    )
+    return added, removed
+
+
+async def get_user_id(client=None):
     "get the spotify_id of the current user"
-    if token is None:
-        token = SpotifyAccessToken()
-        await token.ensure_valid()
-    url = "https://api.spotify.com/v1/me"
-    async with aiohttp.ClientSession(headers=token.auth_header) as session:
-        async with session.get(url) as resp:
-            while True:
-                async with session.get(url) as resp:
-                    if resp.status == 429:
-                        log.debug("Rate limit exceded, waiting...")
-                        await asyncio.sleep(resp.headers["Retry-After"] + 1)
-                        continue
-                    json = await resp.json()
-                    return json["id"]
+    client = client or get_client()
+    json = await client.get_json("https://api.spotify.com/v1/me")
+    return json["id"]
 
 
 def generate_auth_url():
     data = {
-        "client_id": CLIENT_ID,
+        "client_id": client_credentials()[0],
         "response_type": "code",
         "redirect_uri": "http://127.0.0.1:8989/",
         "scope": "playlist-modify-private",
@@ -233,7 +467,8 @@ class SpotifyAccessToken:
             "grant_type": "authorization_code",
         }
         async with aiohttp.ClientSession() as session:
-            async with session.post(TOKEN_URL, headers=AUTH_HEADER, data=data) as resp:
+            headers = client_credentials()[1]
+            async with session.post(TOKEN_URL, headers=headers, data=data) as resp:
                 token_info = await resp.json()
                 if resp.status != 200:
                     raise ValueError(resp.reason, token_info)
@@ -248,7 +483,8 @@ class SpotifyAccessToken:
             "grant_type": "refresh_token",
         }
         async with aiohttp.ClientSession() as session:
-            async with session.post(TOKEN_URL, headers=AUTH_HEADER, data=data) as resp:
+            headers = client_credentials()[1]
+            async with session.post(TOKEN_URL, headers=headers, data=data) as resp:
                 token_info = await resp.json()
         token_info["expires_at"] = int(time.time()) + token_info["expires_in"]
         self.token_info.update(token_info)
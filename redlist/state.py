@@ -0,0 +1,94 @@
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+from . import config
+from . import playlist
+from . import spotify
+from .matching import TrackInfo
+
+log = logging.getLogger(__name__)
+
+
+def source_key(argument):
+    "A stable name for a playlist argument, the spotify id or absolute file path"
+    return playlist.parse_spotfiy_id(argument) or str(Path(argument).absolute())
+
+
+async def fingerprint(argument):
+    "The spotify snapshot_id or a hash of the file contents of a playlist argument"
+    spotify_id = playlist.parse_spotfiy_id(argument)
+    if spotify_id:
+        return await spotify.fetch_snapshot_id(spotify_id)
+    return hashlib.sha1(Path(argument).read_bytes()).hexdigest()
+
+
+class PlaylistState:
+    """
+    What a playlist contained and how each track was resolved on the last run.
+    Stored as json in the config directory, use PlaylistState.load(argument).
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.fingerprint = None
+        self.title = None
+        self.tracks = []  # [(TrackInfo, path or None)]
+        self.missing_playlist = None  # spotify id of the missing tracks playlist
+
+    @property
+    def path(self):
+        digest = hashlib.sha1(self.source.encode("utf8")).hexdigest()
+        return Path(config.config_dir()) / "state" / f"{digest}.json"
+
+    @classmethod
+    def load(cls, argument):
+        state = cls(source_key(argument))
+        try:
+            data = json.loads(state.path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            log.debug("No usable state for %s: %s", state.source, e)
+            return state
+        state.fingerprint = data["fingerprint"]
+        state.title = data["title"]
+        state.tracks = [(TrackInfo(json=t), p) for t, p in data["tracks"]]
+        state.missing_playlist = data.get("missing_playlist")
+        return state
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "source": self.source,
+            "fingerprint": self.fingerprint,
+            "title": self.title,
+            "tracks": [(t.json(), p) for t, p in self.tracks],
+            "missing_playlist": self.missing_playlist,
+        }
+        with open(self.path, "w") as fout:
+            json.dump(data, fout)
+        log.debug("Saved playlist state to %s", self.path)
+
+    def update(self, fingerprint, title, matched):
+        "record the results of a run from a TrackInfo -> item mapping"
+        self.fingerprint = fingerprint
+        self.title = title
+        self.tracks = [
+            (t, os.fsdecode(item.path) if item is not None else None)
+            for t, item in matched.items()
+            if isinstance(t, TrackInfo)
+        ]
+
+    def resolve(self, lib, track_info):
+        """
+        Return an OrderedDict of track_info -> item, filled in for the tracks that
+        were resolved on a previous run and are still in the library.
+        """
+        previous = {t.key: p for t, p in self.tracks if p}
+        items = playlist.items_by_path(lib, set(previous.values()))
+        matched = OrderedDict()
+        for t in track_info:
+            matched[t] = items.get(previous.get(t.key))
+        return matched
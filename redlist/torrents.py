@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import hashlib
+import logging
+from collections import namedtuple
+from pathlib import Path
+
+from . import config
+from . import bencode
+
+log = logging.getLogger(__name__)
+
+TorrentFile = namedtuple(
+    "TorrentFile", "filename mtime info_hash torrent_id name files size"
+)
+
+TORRENT_ID = re.compile(rb"torrentid=(\d+)")
+FILENAME_ID = re.compile(r"-(\d+)\.torrent$")
+
+
+def _text(value):
+    return value.decode("utf8", "replace") if isinstance(value, bytes) else value
+
+
+def read_torrent(path, mtime=None):
+    "Parse a .torrent file into a TorrentFile"
+    data = Path(path).read_bytes()
+    meta, info_hash = bencode.decode_torrent(data)
+    info = meta.get(b"info", {})
+    name = _text(info.get(b"name", b""))
+    if b"files" in info:
+        files = ["/".join(_text(p) for p in f[b"path"]) for f in info[b"files"]]
+        size = sum(f[b"length"] for f in info[b"files"])
+    else:
+        files = [name]
+        size = info.get(b"length", 0)
+    match = FILENAME_ID.search(os.path.basename(path))
+    if not match:
+        match = TORRENT_ID.search(meta.get(b"comment", b""))
+    torrent_id = int(match.group(1)) if match else None
+    if mtime is None:
+        mtime = os.stat(path).st_mtime
+    return TorrentFile(
+        os.path.basename(path), mtime, info_hash, torrent_id, name, files, size
+    )
+
+
+class TorrentIndex:
+    """
+    Index of the .torrent files in a directory by info-hash and [REDACTED]
+    torrent id. Parsed files are cached in the config dir and only re-read when
+    their mtime changes.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.torrents = {}  # filename -> TorrentFile
+        self._load_cache()
+        self.refresh()
+
+    @property
+    def cache_path(self):
+        digest = hashlib.sha1(str(self.directory.absolute()).encode("utf8")).hexdigest()
+        return Path(config.config_dir()) / "torrent_index" / f"{digest}.json"
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as fin:
+                self.torrents = {t[0]: TorrentFile(*t) for t in json.load(fin)}
+        except (FileNotFoundError, json.JSONDecodeError, TypeError) as e:
+            log.debug("No usable torrent index cache: %s", e)
+
+    def save(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, "w") as fout:
+            json.dump(list(self.torrents.values()), fout)
+
+    def refresh(self):
+        "re-read new or changed .torrent files, drop deleted ones"
+        torrents = {}
+        changed = False
+        if not self.directory.is_dir():
+            log.debug("%s does not exist yet, no torrents indexed.", self.directory)
+            self.torrents, self.by_hash, self.by_id = {}, {}, {}
+            return
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".torrent") or not entry.is_file():
+                    continue
+                mtime = entry.stat().st_mtime
+                cached = self.torrents.get(entry.name)
+                if cached is not None and cached.mtime == mtime:
+                    torrents[entry.name] = cached
+                    continue
+                try:
+                    torrents[entry.name] = read_torrent(entry.path, mtime)
+                except (OSError, bencode.BencodeError, AttributeError, KeyError):
+                    log.warning("Could not read torrent file %s.", entry.path)
+                    log.debug("Error details:", exc_info=True)
+                    continue
+                changed = True
+        changed = changed or torrents.keys() != self.torrents.keys()
+        self.torrents = torrents
+        self.by_hash = {t.info_hash: t for t in torrents.values()}
+        self.by_id = {t.torrent_id: t for t in torrents.values() if t.torrent_id}
+        if changed:
+            self.save()
+        log.debug("Indexed %d torrent files in %s.", len(torrents), self.directory)
+
+    def __len__(self):
+        return len(self.torrents)
+
+    def find(self, torrent):
+        "return the saved TorrentFile for a [REDACTED] torrent dict, or None"
+        info_hash = torrent.get("infoHash")
+        if info_hash and info_hash.lower() in self.by_hash:
+            return self.by_hash[info_hash.lower()]
+        return self.by_id.get(int(torrent["torrentId"]))
@@ -1,4 +1,3 @@
-from pynentry import PynEntry
 from getpass import getpass
 import logging
 import os
@@ -7,6 +6,7 @@ import tempfile
 import re
 
 from . import config
+from . import pinentry_available
 
 
 class UserMessenger(logging.Formatter):
@@ -38,9 +38,11 @@ def get_user_and_pass(cfg, name=None, overwrite=False, error=None):
         cfg['username'] = input(f'{name} Username: ')
     if cfg['password'].get() is not None and overwrite != True:
         return
-    if not config['pinentry'].get():
+    if not config['pinentry'].get() or not pinentry_available():
         cfg['password'] = getpass(f'{name} Password: ')
         return
+    from pynentry import PynEntry
+
     with PynEntry() as p:
         p.title = f'{name} Password'
         desc = f'Please enter your password for {name}.'
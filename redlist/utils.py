@@ -1,20 +1,38 @@
+import asyncio
+import importlib.util
 import itertools
 import logging
+import sys
 from pathlib import Path
 
 import humanize
-from beets import config as beetconfig
 
 API = None
 log = logging.getLogger(__name__)
-USER_BUFFER = None
 
 
 class NotEnoughDownloadBuffer(Exception):
     pass
 
 
+def lazy_import(name):
+    "import a module, deferring its execution until an attribute is used"
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
 def resolve_configured_paths(cfg):
+    from beets import config as beetconfig
+
     paths = {}
     if cfg["beets_library"].get():
         paths["beets_library"] = Path(cfg["beets_library"].as_filename()).absolute()
@@ -32,22 +50,109 @@ def resolve_configured_paths(cfg):
     cfg.set_args(paths)
 
 
-async def check_dl_buffer(new_torrent_groups, api, cache=True):
-    global USER_BUFFER
-    buff = USER_BUFFER
-    if not USER_BUFFER or not cache:
-        user_data = await api.request("user", id=api.user_id)
-        user_data = user_data["response"]
-        buff = user_data["stats"]["buffer"]
-        USER_BUFFER = buff
-    new_dl = sum(g["torrent"]["size"] for g in new_torrent_groups)
-    new_buff = buff - new_dl
-    if new_buff <= 0:
-        raise NotEnoughDownloadBuffer(
-            f"Downloading these {len(new_torrent_groups)} torrents will exceted your"
-            f"download buffer by {humanize.naturalsize(-new_buff, gnu=True)}!"
-        )
-    return new_buff
+def is_free(torrent):
+    "downloading this torrent costs no buffer, so a FL token would be wasted"
+    return any(
+        torrent.get(k)
+        for k in ("isFreeleech", "isNeutralLeech", "isPersonalFreeleech")
+    )
+
+
+def plan_fl_tokens(torrent_groups, tokens=None, min_size=0):
+    """
+    Choose which torrents to spend freeleech tokens on -> set of torrentIds
+    The largest torrents over min_size bytes get the tokens, up to `tokens` of
+    them (all of them if tokens is None).
+    """
+    torrents = [g["torrent"] for g in torrent_groups]
+    canidates = sorted(
+        (t for t in torrents if t["size"] > min_size and not is_free(t)),
+        key=lambda t: t["size"],
+        reverse=True,
+    )
+    if tokens is not None:
+        canidates = canidates[:tokens]
+    return {t["torrentId"] for t in canidates}
+
+
+def torrent_cost(torrent, fl_ids=()):
+    "bytes of buffer downloading a torrent will use"
+    if torrent["torrentId"] in fl_ids or is_free(torrent):
+        return 0
+    return torrent["size"]
+
+
+class BufferLedger:
+    """
+    The user's download buffer, fetched once and shared by everything that
+    schedules downloads. Space is reserved when a torrent is scheduled and
+    released again if it fails. Should not be instantiated directly; instead
+    use get_ledger()
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.buffer = None
+        self.reserved = 0
+        self._lock = asyncio.Lock()
+
+    async def fetch(self, refresh=False):
+        "the user's buffer in bytes, only asking the api the first time"
+        async with self._lock:
+            if self.buffer is None or refresh:
+                user_data = await self.api.request("user", id=self.api.user_id)
+                self.buffer = user_data["response"]["stats"]["buffer"]
+                log.debug("Download buffer is %d bytes.", self.buffer)
+        return self.buffer
+
+    @property
+    def remaining(self):
+        return self.buffer - self.reserved
+
+    async def estimate(self, torrent_groups, fl_ids=()):
+        "remaining buffer after downloading torrent_groups, without reserving it"
+        await self.fetch()
+        new_dl = sum(torrent_cost(g["torrent"], fl_ids) for g in torrent_groups)
+        new_buff = self.remaining - new_dl
+        if new_buff <= 0:
+            raise NotEnoughDownloadBuffer(
+                f"Downloading these {len(torrent_groups)} torrents will exceted your"
+                f" download buffer by {humanize.naturalsize(-new_buff, gnu=True)}!"
+            )
+        return new_buff
+
+    async def reserve(self, size, strict=True):
+        """
+        set aside size bytes for a download, raises NotEnoughDownloadBuffer
+        unless strict is off because the user chose to go past their buffer
+        """
+        await self.fetch()
+        async with self._lock:
+            if strict and size and size >= self.remaining:
+                raise NotEnoughDownloadBuffer(
+                    f"Not enough buffer left for {humanize.naturalsize(size, gnu=True)}"
+                )
+            self.reserved += size
+
+    def release(self, size):
+        "give back a reservation for a download that did not happen"
+        self.reserved -= size
+
+    def reset(self):
+        "forget the buffer and reservations, the buffer is fetched again on next use"
+        self.buffer = None
+        self.reserved = 0
+
+
+LEDGER = None
+
+
+def get_ledger(api):
+    "Return the BufferLedger shared by this run"
+    global LEDGER
+    if LEDGER is None or LEDGER.api is not api:
+        LEDGER = BufferLedger(api)
+    return LEDGER
 
 
 def chunk(iterable, n):
@@ -19,6 +19,8 @@ setup(
         "pynentry",
         "deluge_client",
         "cryptography",
+        "unidecode",
+        "numpy",
     ],
     tests_require=[
         "pytest >= 2.8.7",
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from redlist import daemon
+
+
+@pytest.mark.asyncio
+async def test_watch_only_processes_changes(tmp_path):
+    a, b = tmp_path / "a.txt", tmp_path / "b.txt"
+    a.write_text("Rjd2 , Ghostwriter\n")
+    b.write_text("Kid Koala , Fender Bender\n")
+    playlists = [str(a), str(b)]
+    processed = []
+
+    async def process(source):
+        processed.append(source)
+        if source == str(b) and processed.count(source) == 1:
+            raise RuntimeError("first try fails")
+
+    queue = daemon.JobQueue(tmp_path / "jobs.json")
+    await daemon.watch(playlists, process, queue=queue, once=True)
+    assert processed == playlists
+    assert list(queue.pending) == [str(b)]
+
+    # b is retried, a is unchanged, and the queue survives a restart
+    queue = daemon.JobQueue(tmp_path / "jobs.json")
+    await daemon.watch(playlists, process, queue=queue, once=True)
+    assert processed == playlists + [str(b)]
+    assert len(queue) == 0
+
+    a.write_text("Rjd2 , Ghostwriter\nNobody , Missing Song\n")
+    await daemon.watch(playlists, process, queue=queue, once=True)
+    assert processed == playlists + [str(b), str(a)]
+
+
+@pytest.mark.asyncio
+async def test_watch_stops_between_jobs(tmp_path):
+    playlists = []
+    for name in "abc":
+        path = tmp_path / f"{name}.txt"
+        path.write_text("Rjd2 , Ghostwriter\n")
+        playlists.append(str(path))
+    stop = asyncio.Event()
+    processed = []
+
+    async def process(source):
+        processed.append(source)
+        stop.set()  # as the signal handler would, mid job
+
+    queue = daemon.JobQueue(tmp_path / "jobs.json")
+    await asyncio.wait_for(daemon.watch(playlists, process, queue=queue, stop=stop), 5)
+    assert processed == playlists[:1]
+    assert list(queue.pending) == playlists[1:]
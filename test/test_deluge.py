@@ -1,4 +1,5 @@
 import pytest
+import asyncio
 
 from redlist import deluge
 import deluge_client
@@ -80,3 +81,64 @@ async def test_client_add_torrent():
         'Kid Koala - Carpal Tunnel Syndrome - 2013 (WEB - MP3 - V0 (VBR))-1364328.torrent',
         data,
         paused=True)
+
+
+class FlakyRPCClient:
+    "drops the connection on the first call"
+
+    def __init__(self, host, port, username, password, decode_utf8=False):
+        self.host, self.port = host, port
+        self.connected = False
+        self.connects = 0
+        self.calls = []
+
+    def connect(self):
+        self.connected = True
+        self.connects += 1
+
+    def disconnect(self):
+        self.connected = False
+
+    def call(self, method, *args):
+        if method == 'core.get_torrents_status':
+            return {
+                'ABC': {'name': 'Album', 'trackers': [{'url': 'https://flacsfor.me/x'}]},
+                'DEF': {'name': 'Other', 'trackers': [{'url': 'https://example.com'}]},
+            }
+        filename = args[0]
+        if not self.calls:
+            self.calls.append(None)
+            raise deluge_client.client.FailedToReconnectException()
+        self.calls.append(filename)
+        return filename.upper()
+
+
+@pytest.mark.asyncio
+async def test_client_reconnects(monkeypatch):
+    deluge.config['deluge']['password'] = '123'
+    deluge.config['deluge']['username'] = 'user123'
+    monkeypatch.setattr(deluge_client, 'DelugeRPCClient', FlakyRPCClient)
+    monkeypatch.setattr(deluge.time, 'sleep', lambda s: None)
+    async with deluge.Client() as client:
+        results = await asyncio.gather(
+            *(client.add_torrent_file(f't{n}', b'data') for n in range(3)))
+        rpc = client._client
+    assert results == ['T0', 'T1', 'T2']
+    assert rpc.connects == 2
+    assert not rpc.connected
+
+
+@pytest.mark.asyncio
+async def test_existing_torrents(monkeypatch):
+    deluge.config['deluge']['password'] = '123'
+    deluge.config['deluge']['username'] = 'user123'
+    monkeypatch.setattr(deluge_client, 'DelugeRPCClient', FlakyRPCClient)
+    async with deluge.Client() as client:
+        client._client.calls.append(None)  # don't drop the connection
+        existing = await client.existing_torrents()
+    assert existing.hashes == {'abc', 'def'}
+    assert existing.names == {'Album'}
+    assert deluge.is_added({'infoHash': 'Abc'}, existing)
+    assert not deluge.is_added({'infoHash': '123', 'filePath': 'Album'}, existing)
+    assert deluge.is_added({'filePath': 'Album'}, existing)
+    assert not deluge.is_added({'filePath': 'Other'}, existing)
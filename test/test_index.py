@@ -0,0 +1,154 @@
+import dataclasses
+
+import pytest
+
+import beets.library
+
+from redlist import matching, settings
+from redlist.index import LibraryIndex, normalize_artist, normalize_title, trigrams
+from redlist.matching import TrackInfo, beets_match
+
+ITEMS = [
+    ("Daft Punk", "Solar Sailer", "TRON: Legacy", 162.0),
+    ("Daft Punk", "Derezzed", "TRON: Legacy", 104.0),
+    ("Kid Koala", "Like Irregular Chickens", "Carpal Tunnel Syndrome", 250.0),
+    ("Rjd2", "Ghostwriter", "Deadringer", 311.0),
+    ("Beyoncé", "Crazy in Love", "Dangerously in Love", 236.0),
+    ("Bonobo", "Kong Part II", "Days to Come", 240.0),
+]
+
+
+@pytest.fixture
+def lib(tmp_path):
+    lib = beets.library.Library(":memory:")
+    for artist, title, album, length in ITEMS:
+        item = beets.library.Item(artist=artist, title=title, album=album, length=length)
+        item.path = str(tmp_path / f"{title}.mp3").encode()
+        lib.add(item)
+    return lib
+
+
+def test_normalize_title():
+    assert normalize_title("Kong, Pt. II") == normalize_title("Kong Part 2")
+    assert normalize_title("Crazy In Love - 2003 Remaster") == "crazy in love"
+    assert normalize_title("Rock & Roll") == "rock and roll"
+    assert normalize_title("Déjà Vu (feat. Somebody)") == "deja vu"
+
+
+def test_normalize_artist():
+    assert normalize_artist("Beyoncé & Jay-Z") == "beyonce and jay z"
+
+
+def test_trigrams():
+    assert trigrams("ab") == {"  a", " ab", "ab "}
+
+
+def test_candidates(lib):
+    index = LibraryIndex(lib)
+    assert len(index) == len(ITEMS)
+    track = TrackInfo("Bonobo", "Kong, Pt. 2")
+    assert index.candidates(track, limit=1)[0].title == "Kong Part II"
+    track = TrackInfo("Daft Punk", "Derezzed - Remastered")
+    assert index.candidates(track)[0].title == "Derezzed"
+
+
+def test_candidates_rank_by_artist(lib, tmp_path):
+    # more songs share the title than candidates are returned
+    for n in range(30):
+        item = beets.library.Item(artist=f"Band {n}", title="Intro", length=60.0)
+        item.path = str(tmp_path / f"intro {n}.mp3").encode()
+        lib.add(item)
+    item = beets.library.Item(artist="Rjd2", title="Intro", length=60.0)
+    item.path = str(tmp_path / "intro.mp3").encode()
+    lib.add(item)
+    index = LibraryIndex(lib)
+    track = TrackInfo("RJD2", "Intro", length="1:00")
+    assert index.candidates(track)[0].artist == "Rjd2"
+    assert beets_match([track], lib, index=index)[track].id == item.id
+
+
+def test_beets_match_with_index(lib):
+    index = LibraryIndex(lib)
+    tracks = [
+        TrackInfo("Beyonce", "Crazy In Love - 2003 Remaster", length="3:56"),
+        TrackInfo("Daft Punk", "Solar Sailer", length="2:42"),
+        TrackInfo("Nobody", "Nothing Like This", length="1:00"),
+    ]
+    matched = beets_match(tracks, lib, index=index)
+    assert matched[tracks[0]].title == "Crazy in Love"
+    assert matched[tracks[1]].title == "Solar Sailer"
+    assert matched[tracks[2]] is None
+
+
+def test_parallel_beets_match(lib):
+    index = LibraryIndex(lib)
+    tracks = [TrackInfo(a, t, length=str(int(l))) for a, t, _, l in ITEMS]
+    tracks.append(TrackInfo("Nobody", "Nothing Like This"))
+    serial = beets_match(tracks, lib, index=index)
+    matching.WORKER_CACHE_COUNTS.clear()
+    parallel = beets_match(tracks, lib, index=index, workers=2)
+    assert list(parallel) == tracks
+    for t in tracks:
+        assert getattr(serial[t], "id", None) == getattr(parallel[t], "id", None)
+    assert parallel[tracks[-1]] is None
+    # the workers' cache use is reported too
+    assert sum(matching.WORKER_CACHE_COUNTS["distance"]) > 0
+
+
+@pytest.fixture
+def strict_threshold():
+    "a threshold low enough for the length penalty alone to rule a match out"
+    current = settings.get()
+    settings.use(dataclasses.replace(current, match_threshold=0.2))
+    yield
+    settings.use(current)
+
+
+def test_length_prefilter(lib, strict_threshold):
+    lib.add(beets.library.Item(artist="Daft Punk", title="Derezzed (Live)", length=0))
+    index = LibraryIndex(lib)
+    assert list(index.lengths) == sorted(l for *_, l in ITEMS)
+    short = TrackInfo("Daft Punk", "Derezzed", length="1:44")
+    long = TrackInfo("Daft Punk", "Derezzed", length="9:00")
+    unknown = TrackInfo("Daft Punk", "Derezzed")
+    assert {e.title for e in index.candidates(short)} == {"Derezzed", "Derezzed (Live)"}
+    assert [e.title for e in index.candidates(long)] == ["Derezzed (Live)"]
+    assert len(index.candidates(unknown)) == 2
+    assert beets_match([long], lib, index=index)[long].title == "Derezzed (Live)"
+
+
+def test_length_prefilter_keeps_acceptable_matches(lib):
+    # a full track_length penalty only adds 2.0 / 8.0 = 0.25 to the distance,
+    # under the default 0.3 threshold, so the length must not rule this out
+    lib.add(beets.library.Item(artist="Daft Punk", title="Around the World", length=429))
+    track = TrackInfo("Daft Punk", "Around the World", length="3:58")
+    index = LibraryIndex(lib)
+    assert [e.title for e in index.candidates(track)] == ["Around the World"]
+    for idx in (None, index):
+        assert beets_match([track], lib, index=idx)[track].length == 429
+
+
+def test_exact_match_prunes_by_length(lib, monkeypatch):
+    # with the shipped weights no length is ruled out by the threshold alone
+    assert matching.length_window(104.0) is None
+    for length in (300.0, 400.0):
+        lib.add(beets.library.Item(artist="Daft Punk", title="Derezzed", length=length))
+    scored = []
+    track_distances = matching.track_distances
+
+    def counting(track_info, items, restrict_album=False):
+        scored.extend(i.length for i in items)
+        return track_distances(track_info, items, restrict_album)
+
+    monkeypatch.setattr(matching, "track_distances", counting)
+    track = TrackInfo("Daft Punk", "Derezzed", length="1:44")
+    best = matching.best_canidate(track, list(lib.items()), 0.3)
+    # but once the exact match is found nothing further away can beat it
+    assert best.length == 104.0
+    assert scored == [104.0]
+
+    scored.clear()
+    track = TrackInfo("Daft Punk", "Derezzed", length="5:30")
+    assert matching.best_canidate(track, list(lib.items()), 0.3).length == 300.0
+    # with nothing close by every length is still scored
+    assert sorted(scored) == sorted([l for *_, l in ITEMS] + [300.0, 400.0])
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+import beets.library
+from beets.dbcore.db import DBAccessError
+
+from redlist.library import AsyncLibrary
+from redlist.matching import TrackInfo
+
+
+@pytest.fixture
+def library(tmp_path):
+    path = str(tmp_path / 'library.db')
+    lib = beets.library.Library(path)
+    lib.add(beets.library.Item(artist='Rjd2', title='Ghostwriter', length=311.0))
+    lib.add(beets.library.Item(artist='Kid Koala', title='Fender Bender', length=150.0))
+    lib._close()
+    library = AsyncLibrary(path)
+    yield library
+    library.close()
+
+
+@pytest.mark.asyncio
+async def test_async_match(library):
+    index = await library.build_index()
+    assert len(index) == 2
+    track = TrackInfo('Rjd2', 'Ghostwriter', length='5:11')
+    matched = await library.match([track], index=index)
+    assert matched[track].title == 'Ghostwriter'
+    assert len(await library.items('artist:koala')) == 1
+
+
+@pytest.mark.asyncio
+async def test_worker_connections_read_only(library):
+    def write(lib):
+        with lib.transaction() as tx:
+            tx.mutate('DELETE FROM items')
+
+    with pytest.raises(DBAccessError):
+        await library.run(write, library.lib)
+    assert len(library.lib.items()) == 2
+
+
+@pytest.mark.asyncio
+async def test_parallel_match_from_library_threads(library):
+    index = await library.get_index()
+    playlists = [
+        [TrackInfo('Rjd2', 'Ghostwriter', length='5:11'), TrackInfo('No', 'One')],
+        [TrackInfo('Kid Koala', 'Fender Bender', length='2:30'), TrackInfo('No', 'Two')],
+    ]
+    results = await asyncio.gather(
+        *(library.match(p, index=index, workers=2) for p in playlists)
+    )
+    for (found, missing), matched in zip(playlists, results):
+        assert matched[found].title == found.title
+        assert matched[missing] is None
+    assert library.match_pool(index, 2) is library._pool
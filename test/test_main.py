@@ -0,0 +1,213 @@
+import pytest
+
+import redlist.__main__ as main
+from redlist import config
+from redlist.matching import TrackInfo
+
+
+@pytest.fixture
+def overrides():
+    "set config values for one test"
+    added = []
+
+    def set_config(values):
+        config.set(values)
+        added.append(config.sources[0])
+
+    yield set_config
+    for source in added:
+        config.sources.remove(source)
+
+
+def group(torrent_id, size):
+    return {"torrent": {"torrentId": torrent_id, "size": size}}
+
+
+class FakeAPI:
+    fl_tokens_used = 0
+
+
+def test_plan_fl_tokens(overrides):
+    downloads = {n: group(n, n * 100) for n in range(1, 5)}
+    api = FakeAPI()
+    assert main.plan_fl_tokens(downloads, api) == set()
+
+    # the default config has no cap, every torrent gets a token
+    overrides({"redacted": {"use_fl_tokens": True}})
+    assert main.plan_fl_tokens(downloads, api) == {1, 2, 3, 4}
+    overrides({"redacted": {"fl_tokens": 0}})
+    assert main.plan_fl_tokens(downloads, api) == {1, 2, 3, 4}
+
+    # tokens spent on earlier playlists count against the cap
+    overrides({"redacted": {"fl_tokens": 3}})
+    assert main.plan_fl_tokens(downloads, api) == {4, 3, 2}
+    api.fl_tokens_used = 2
+    assert main.plan_fl_tokens(downloads, api) == {4}
+    api.fl_tokens_used = 5
+    assert main.plan_fl_tokens(downloads, api) == set()
+
+
+class DownloadAPI:
+    "a fake [REDACTED] api serving torrent files, fails for ids in `broken`"
+
+    user_id = 1
+    fl_tokens_used = 0
+
+    def __init__(self, broken=()):
+        self.broken = broken
+
+    async def request(self, action, **kwargs):
+        return {"response": {"stats": {"buffer": 10000}}}
+
+    async def get_torrent(self, torrent_id, use_fl=False):
+        if torrent_id in self.broken:
+            raise ConnectionResetError("dropped")
+        return f"{torrent_id}.torrent", b"d4:infode"
+
+
+def download(torrent_id, size=100):
+    return {"groupName": f"Album {torrent_id}", **group(torrent_id, size)}
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    def use(api):
+        async def get_api():
+            return api
+
+        monkeypatch.setattr(main.redapi, "get_api", get_api)
+        return main.utils.get_ledger(api)
+
+    return use
+
+
+@pytest.mark.asyncio
+async def test_failed_download_releases_buffer(fake_api, tmp_path):
+    ledger = fake_api(DownloadAPI(broken={2}))
+    await main.dl_torrent_to_file(download(1), tmp_path)
+    with pytest.raises(ConnectionResetError):
+        await main.dl_torrent_to_file(download(2), tmp_path)
+    assert ledger.reserved == 100
+    assert [p.name for p in tmp_path.iterdir()] == ["1.torrent"]
+
+
+@pytest.mark.asyncio
+async def test_deluge_fallback_skips_added_torrents(
+    fake_api, overrides, tmp_path, monkeypatch
+):
+    ledger = fake_api(DownloadAPI())
+
+    class Client:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        async def existing_torrents(self):
+            return main.deluge.ExistingTorrents(set(), set())
+
+        async def add_torrent_file(self, filename, data, paused):
+            if filename == "2.torrent":
+                raise ConnectionRefusedError()
+            return "hash"
+
+    monkeypatch.setattr(main.deluge, "Client", Client)
+    monkeypatch.setattr(config, "config_dir", lambda: str(tmp_path))
+    dl_dir = tmp_path / "downloads"
+    dl_dir.mkdir()
+    overrides({"enable_deluge": True, "torrent_directory": str(dl_dir)})
+    downloads = {"a": download(1), "b": download(2)}
+    await main.download_torrents(downloads)
+    # only the torrent deluge did not take is saved, its buffer reserved once
+    assert [p.name for p in dl_dir.iterdir()] == ["2.torrent"]
+    assert ledger.reserved == 200
+
+
+@pytest.mark.asyncio
+async def test_going_past_the_buffer_is_not_remembered(fake_api, tmp_path):
+    ledger = fake_api(DownloadAPI())
+    await main.dl_torrent_to_file(download(1, 20000), tmp_path, strict=False)
+    await main.dl_torrent_to_file(download(2), tmp_path)
+    assert [p.name for p in tmp_path.iterdir()] == ["1.torrent"]
+    assert ledger.reserved == 20000
+
+
+@pytest.mark.asyncio
+async def test_main_batch(overrides, monkeypatch, tmp_path):
+    found = TrackInfo("Rjd2", "Ghostwriter")
+    shared = TrackInfo("Nobody", "Missing Song")
+    # the same song parsed from the second playlist
+    shared_b = TrackInfo("Nobody", "Missing Song")
+    missing_b = TrackInfo("Kid Koala", "Fender Bender")
+    unmatched = {"a.txt": [found, shared], "b.txt": [shared_b, missing_b]}
+
+    async def match_playlist(spotlist, library):
+        if spotlist not in unmatched:
+            raise FileNotFoundError(spotlist)
+        return spotlist, {}, unmatched[spotlist]
+
+    searched = []
+
+    async def search_missing(tracks, yes=False):
+        searched.append(tracks)
+        return [shared, missing_b]  # found was downloaded
+
+    offered = {}
+
+    async def offer_missing_playlist(spotlist, title, missing, prompt=True):
+        offered[spotlist] = missing
+
+    monkeypatch.setattr(main, "match_playlist", match_playlist)
+    monkeypatch.setattr(main, "save_m3u", lambda *args: None)
+    monkeypatch.setattr(main, "search_missing", search_missing)
+    monkeypatch.setattr(main, "offer_missing_playlist", offer_missing_playlist)
+    monkeypatch.setattr(main.libraries, "get_library", lambda path: None)
+    overrides({"beets_library": str(tmp_path / "library.db")})
+
+    # the broken playlist fails the run without stopping the others
+    assert await main.main_batch(["a.txt", "broken.txt", "b.txt"], yes=True) == 1
+    # a track shared by both playlists is searched for once
+    assert len(searched) == 1
+    assert [t.key for t in searched[0]] == [found.key, shared.key, missing_b.key]
+    # and what is still missing goes back to each playlist it came from
+    assert offered == {"a.txt": [shared], "b.txt": [shared_b, missing_b]}
+
+
+@pytest.mark.asyncio
+async def test_nothing_found_keeps_missing_playlist(
+    overrides, fake_api, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(config, "config_dir", lambda: str(tmp_path))
+    tracks = [TrackInfo("Nobody", "Missing Song", spotify_id="1")]
+    playlist_state = main.state.PlaylistState.load("a.txt")
+    playlist_state.missing_playlist = "abc"
+    playlist_state.save()
+
+    async def match_playlist(spotlist, library):
+        return "a", {t: None for t in tracks}, list(tracks)
+
+    async def find_album(track, restrict_album=False):
+        return None  # [REDACTED] has nothing either
+
+    updates = []
+
+    async def make_missing_spotify_playlist(title, trackinfos, playlist_id=None):
+        updates.append((trackinfos, playlist_id))
+        return playlist_id
+
+    fake_api(DownloadAPI())
+    monkeypatch.setattr(main, "match_playlist", match_playlist)
+    monkeypatch.setattr(main, "save_m3u", lambda *args: None)
+    monkeypatch.setattr(main.libraries, "get_library", lambda path: None)
+    monkeypatch.setattr(main.redsearch, "find_album", find_album)
+    monkeypatch.setattr(
+        main.playlist, "make_missing_spotify_playlist", make_missing_spotify_playlist
+    )
+    overrides(
+        {"beets_library": str(tmp_path / "library.db"), "missing_track_playlist": "yes"}
+    )
+
+    assert await main.main("a.txt", yes=True) == 0
+    assert updates == [(tracks, "abc")]
+    assert main.state.PlaylistState.load("a.txt").missing_playlist == "abc"
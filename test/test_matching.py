@@ -169,3 +169,105 @@ def test_track_info_from_spotify():
                     album='Cold Water Music',
                     length=245.946,
                     feat='Qnc'))
+
+
+STRING_PAIRS = [
+    ('The Beatles', 'Beatles, The'),
+    ('Crazy In Love (feat. Jay-Z)', 'Crazy in Love'),
+    ('Kong, Pt. 2', 'Kong Part II'),
+    ('Up, Bustle & Out', 'Up, Bustle and Out'),
+    ('Solar Sailer [Remastered]', 'Solar Sailer'),
+    ('Beyoncé', 'Beyonce'),
+    ('', 'Something'),
+    ('!!!', ''),
+    ('Daft Punk', 'Kid Koala'),
+]
+
+
+def test_string_distances_match_beets():
+    from beets.autotag.distance import string_dist
+    for a, b in STRING_PAIRS:
+        batch = m.string_distances(a, [b, a, None])
+        assert batch[0] == pytest.approx(string_dist(a, b))
+        assert batch[1] == pytest.approx(string_dist(a, a))
+        assert batch[2] == 1.0
+
+
+def test_track_distances_match_beets():
+    track = m.TrackInfo('Daft Punk', 'Solar Sailer', 'TRON: Legacy', '2:42')
+    items = [
+        m.TrackInfo('Daft Punk', 'Solar Sailer', 'TRON: Legacy', '2:44'),
+        m.TrackInfo('Various Artists', 'Solar Sailor', 'Tron', '4:00'),
+        m.TrackInfo('Daft Punk', 'Derezzed', None, None),
+        m.TrackInfo('Kid Koala', 'Solar Sailer (Live)', 'Other', '1:02'),
+    ]
+    for restrict_album in (False, True):
+        batch = m.track_distances(track, items, restrict_album=restrict_album)
+        for dist, item in zip(batch, items):
+            expected = m.track_distance(item, track, restrict_album=restrict_album)
+            assert dist == pytest.approx(float(expected))
+
+
+def test_match_artist_equal_distances():
+    assert m.match_artist('rjd2', ['rjd2', 'RJD2']) == 'rjd2'
+    assert m.match_artist('rjd2', {'kid koala'}) is None
+    assert m.match_artist('rjd2', []) is None
+
+
+def test_distance_cache():
+    m.DISTANCES.clear()
+    m.WORKER_CACHE_COUNTS.clear()
+    first = m.string_distances('Solar Sailer', ['Solar Sailor', 'Derezzed'])
+    assert m.DISTANCES.cache_info().misses == 2
+    second = m.string_distances('Solar Sailor', ['Solar Sailer'])
+    assert second[0] == first[0]
+    assert m.DISTANCES.cache_info().hits == 1
+    assert 'distance 33% of 3' in m.cache_summary()
+
+    cache = m.DistanceCache(2)
+    cache.set('a', 'b', 0.5)
+    cache.set('a', 'c', 0.6)
+    assert cache.get('b', 'a') == 0.5
+    cache.set('a', 'd', 0.7)
+    assert cache.get('a', 'c') is None
+    assert cache.cache_info().currsize == 2
+
+
+def test_distance_cache_threads():
+    import threading
+    from collections import OrderedDict
+    cache = m.DistanceCache(1)
+
+    class EvictingDict(OrderedDict):
+        "another thread fills the cache between the lookup and move_to_end"
+        def __getitem__(self, key):
+            value = super().__getitem__(key)
+            other = threading.Thread(target=cache.set, args=('x', 'y', 1.0))
+            other.start()
+            other.join(0.2)
+            self.other = other
+            return value
+
+    cache.data = EvictingDict()
+    cache.set('a', 'b', 0.5)
+    assert cache.get('a', 'b') == 0.5
+    cache.data.other.join()
+    assert cache.get('x', 'y') == 1.0
+
+
+def test_track_info_identity():
+    import pickle
+    a = m.TrackInfo('Daft Punk', 'Solar Sailer', 'TRON: Legacy', '2:42')
+    b = m.TrackInfo(artist='daft punk', title='Solar Sailer', album='Tron Legacy',
+                    length=162.3, spotify_id='0Jc2SfIHv63JNsUZpunh54')
+    c = m.TrackInfo('Daft Punk', 'Derezzed', 'TRON: Legacy', '1:44')
+    assert a.key == b.key and a.key != c.key
+    assert a != b
+    assert len({a, b, c}) == 3
+    assert b.spotify_id == '0Jc2SfIHv63JNsUZpunh54'
+    assert not hasattr(a, 'spotify_id')
+    assert b.fields == ['artist', 'title', 'album', 'length', 'spotify_id']
+    assert not hasattr(a, '__dict__')
+
+    copy = pickle.loads(pickle.dumps(b))
+    assert copy.key == b.key and copy.json() == b.json()
@@ -7,7 +7,7 @@ from fuzzywuzzy import fuzz
 import beets.library
 
 import redlist.playlist as pl
-from redlist.matching import TrackInfo
+from redlist.matching import TrackInfo, beets_match
 
 MUSIC = Path('lounge')
 SPOTLIST = Path('test/txtpl.txt')
@@ -49,3 +49,40 @@ def test_parse_track_info_string():
         """# TrackInfo(json='{"artist": "Daft Punk", "title": "Solar Sailer", "album": "TRON\'s, Legacy", "length": 162.12, "spotify_id": "0Jc2SfIHv63JNsUZpunh54"}')"""
     )
     assert t.json() == new.json()
+
+
+def test_create_info_from_m3u_bulk(tmp_path):
+    lib = beets.library.Library(':memory:')
+    paths = []
+    for i in range(1200):
+        item = beets.library.Item(artist='Artist', title=f'Track {i}')
+        item.path = str(tmp_path / f'{i:04}.mp3').encode()
+        lib.add(item)
+        paths.append(str(tmp_path / f'{i:04}.mp3'))
+    m3u = tmp_path / 'bulk.m3u'
+    m3u.write_text('\n'.join(['# header'] + paths + [str(tmp_path / 'gone.mp3')]))
+    matches = pl.create_info_from_m3u(m3u, lib)
+    items = [i for i in matches if not isinstance(i, str)]
+    assert [i.title for i in items] == [f'Track {i}' for i in range(1200)]
+    assert list(matches)[0] == '# header'
+
+
+def test_repeated_tracks_keep_their_positions(tmp_path):
+    lib = beets.library.Library(':memory:')
+    for title, length in (('Solar Sailer', 162.0), ('Derezzed', 104.0)):
+        item = beets.library.Item(artist='Daft Punk', title=title, length=length)
+        item.path = str(tmp_path / f'{title}.mp3').encode()
+        lib.add(item)
+    tracks = [
+        TrackInfo('Daft Punk', 'Solar Sailer', length='2:42'),
+        TrackInfo('Daft Punk', 'Derezzed', length='1:44'),
+        TrackInfo('Daft Punk', 'Solar Sailer', length='2:42'),
+    ]
+    matched = beets_match(tracks, lib)
+    assert list(matched) == tracks
+    lines = pl.render_m3u(matched).decode().splitlines()
+    assert [Path(l).stem for l in lines] == ['Solar Sailer', 'Derezzed', 'Solar Sailer']
+
+    m3u = tmp_path / 'repeats.m3u'
+    m3u.write_text('\n'.join(lines) + '\n')
+    assert pl.render_m3u(pl.create_info_from_m3u(m3u, lib)).decode() == m3u.read_text()
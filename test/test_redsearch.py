@@ -114,3 +114,27 @@ def test_choose_prefered_torrent():
     prefs = [r'.*(v0 \(VBR\)|lossless) vinyl', r'mp3 v0', r'flac .*'] 
     prefs = [re.compile(p, re.I) for p in prefs]
     s.choose_prefered_torrent(group, prefs)
+
+
+def test_format_ranker():
+    from groups import group
+    prefs = [r'.*(v0 \(VBR\)|lossless) vinyl', r'mp3 v0', r'flac .*']
+    compiled = [re.compile(p, re.I) for p in prefs]
+    ranker = s.FormatRanker(prefs)
+    # a bit for each preference not matched, the first in the highest bit
+    assert ranker.format_rank('MP3', 'V0 (VBR)', 'Vinyl') == 0b001
+    assert ranker.format_rank('FLAC', 'Lossless', 'Vinyl') == 0b010
+    assert ranker.format_rank('MP3', 'V0 (VBR)', 'CD') == 0b101
+    assert ranker.format_rank('FLAC', 'Lossless', 'CD') == 0b110
+    assert ranker.format_rank('MP3', '320', 'WEB') == 0b111
+    best = s.choose_prefered_torrent(group, compiled)
+    assert best is ranker.choose(group)
+    assert ranker.rank(group['torrents'])[0] is best
+
+    by_size = s.FormatRanker(['.*'], keys=['size'])
+    smallest = min(group['torrents'], key=lambda t: t['size'])
+    assert by_size.choose(group) is smallest
+
+    # fields the api sends as null sort like 0
+    torrents = [{**t, 'seeders': None} for t in group['torrents']]
+    assert ranker.rank(torrents)[0]['format'] == 'MP3'
@@ -0,0 +1,17 @@
+import pickle
+import dataclasses
+
+import pytest
+
+from redlist import settings
+
+
+def test_settings_from_config():
+    s = settings.Settings.from_config()
+    assert s.format_preferences[0].match("mp3 v0 cd")
+    assert s.distance_weights["track_artist"] == 3.0
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        s.restrict_album = True
+    with pytest.raises(TypeError):
+        s.distance_weights["album"] = 1.0
+    assert pickle.loads(pickle.dumps(s)) == s
@@ -1,4 +1,6 @@
 import pytest
+import asyncio
+import time
 from cryptography import fernet
 
 import redlist.spotify as sp
@@ -32,3 +34,187 @@ async def test_fetch_playlist_data():
     name, data = await sp.fetch_play_list_data('1yQQKwc2ZrjfEBQdsheZnH')
     assert name == 'hop dat'
     assert len(data) == 229
+
+
+def _spotify_track(n):
+    return {"track": {"artists": [{"name": "Artist"}], "name": f"Song {n}",
+                      "album": {"name": "Album"}, "duration_ms": 200000 + n,
+                      "id": str(n)}}
+
+
+class FakeClient(sp.SpotifyClient):
+    "answers snapshot requests with snapshot/etag and everything else with get_json"
+
+    def __init__(self, get_json, snapshot="s1", etag='"e1"'):
+        super().__init__(token=object())
+        self.get_json = get_json
+        self.snapshot = snapshot
+        self.etag = etag
+        self.snapshot_requests = 0
+
+    async def request(self, method, url, headers=None, **kwargs):
+        self.snapshot_requests += 1
+        if headers and headers.get("If-None-Match") == self.etag:
+            return sp.Response(304, {}, None)
+        return sp.Response(200, {"ETag": self.etag}, {"snapshot_id": self.snapshot})
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(sp.config, "config_dir", lambda: str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.asyncio
+async def test_fetch_playlist_pages_in_order(config_dir):
+    total = 250
+
+    async def get_json(url, params=None):
+        if "offset" not in params:
+            items = [_spotify_track(n) for n in range(100)]
+            return {"name": "big/list", "snapshot_id": "s1",
+                    "tracks": {"items": items, "limit": 100, "total": total}}
+        offset = params["offset"]
+        # later pages answer first
+        await asyncio.sleep((total - offset) / 10000)
+        end = min(offset + params["limit"], total)
+        return {"items": [_spotify_track(n) for n in range(offset, end)]}
+
+    name, data = await sp.fetch_play_list_data("abc", FakeClient(get_json))
+    assert name == "big_list"
+    assert [t.spotify_id for t in data] == [str(n) for n in range(total)]
+
+
+@pytest.mark.asyncio
+async def test_fetch_playlist_cached(config_dir):
+    fetched = []
+
+    async def get_json(url, params=None):
+        fetched.append(url)
+        return {"name": "pl", "snapshot_id": "s1",
+                "tracks": {"items": [_spotify_track(1)], "limit": 100, "total": 1}}
+
+    # nothing cached yet, so no separate snapshot request
+    client = FakeClient(get_json)
+    assert await sp.fetch_play_list_data("abc", client)
+    assert client.snapshot_requests == 0
+    name, data = await sp.fetch_play_list_data("abc", client)
+    assert len(fetched) == 1 and client.snapshot_requests == 1
+    assert name == "pl" and data[0].spotify_id == "1"
+    assert await sp.fetch_snapshot_id("abc", FakeClient(get_json)) == "s1"
+
+    # a changed playlist is fetched again
+    await sp.fetch_play_list_data("abc", FakeClient(get_json, "s2", '"e2"'))
+    assert len(fetched) == 2
+
+
+@pytest.mark.asyncio
+async def test_fetch_track_data_order():
+    async def get_json(url, params=None):
+        ids = params["ids"].split(",")
+        await asyncio.sleep(1 / (1000 + int(ids[0])))
+        return {"tracks": [{"id": i} for i in ids]}
+
+    ids = [str(n) for n in range(170)]
+    data = await sp.fetch_track_data(*ids, client=FakeClient(get_json))
+    assert [t["id"] for t in data] == ids
+
+
+class FakeResponse:
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+    async def json(self):
+        return {"ok": True}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class RateLimitedSession:
+    "rate limits the first request, records when each request is made"
+
+    closed = False
+
+    def __init__(self):
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(time.monotonic())
+        if len(self.calls) == 1:
+            return FakeResponse(429, {"Retry-After": "0"})
+        return FakeResponse(200)
+
+    async def close(self):
+        pass
+
+
+class FakeToken:
+    is_valid = True
+    auth_header = {}
+    token_info = {"expires_at": time.time() + 3600}
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_backoff_is_shared():
+    client = sp.SpotifyClient(token=FakeToken(), concurrency=2)
+    client._session = session = RateLimitedSession()
+    try:
+        first = asyncio.ensure_future(client.get_json("a"))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(client.get_json("b"))
+        assert await first == await second == {"ok": True}
+    finally:
+        await client.close()
+    # Retry-After: 0 still waits a second before anything is retried
+    assert len(session.calls) == 3
+    assert min(session.calls[1:]) - session.calls[0] >= 1
+
+
+class PlaylistClient(sp.SpotifyClient):
+    "a fake spotify api holding a single playlist"
+
+    def __init__(self, ids):
+        super().__init__(token=FakeToken())
+        self.ids = list(ids)
+        self.writes = []
+
+    async def request(self, method, url, headers=None, params=None, json=None):
+        if method == "GET":
+            page = self.ids[params["offset"] : params["offset"] + params["limit"]]
+            items = [{"track": {"id": i}} for i in page]
+            return sp.Response(200, {}, {"items": items, "total": len(self.ids)})
+        self.writes.append(method)
+        if method == "POST":
+            self.ids.extend(u.split(":")[-1] for u in json["uris"])
+            return sp.Response(201, {}, {})
+        uris = {t["uri"].split(":")[-1] for t in json["tracks"]}
+        self.ids = [i for i in self.ids if i not in uris]
+        return sp.Response(200, {}, {})
+
+
+@pytest.mark.asyncio
+async def test_update_playlist_diff():
+    client = PlaylistClient(str(n) for n in range(150))
+    wanted = [str(n) for n in range(50, 260)]
+    added, removed = await sp.update_playlist("abc", wanted, client)
+    assert sorted(removed, key=int) == [str(n) for n in range(50)]
+    assert added == [str(n) for n in range(150, 260)]
+    assert sorted(client.ids, key=int) == wanted
+    assert client.writes == ["DELETE", "POST", "POST"]
+
+    client.writes = []
+    assert await sp.update_playlist("abc", wanted, client) == ([], [])
+    assert client.writes == []
+
+
+@pytest.mark.asyncio
+async def test_update_playlist_skips_local_tracks():
+    client = PlaylistClient(["1", None, "2"])
+    assert await sp.fetch_playlist_track_ids("abc", client) == ["1", "2"]
+    assert await sp.update_playlist("abc", ["1", "2"], client) == ([], [])
+    assert client.writes == []
@@ -0,0 +1,39 @@
+import pytest
+import beets.library
+
+import redlist
+import redlist.state as st
+from redlist.matching import TrackInfo
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(redlist.config, "config_dir", lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_state_roundtrip(config_dir, tmp_path):
+    lib = beets.library.Library(":memory:")
+    item = beets.library.Item(artist="Daft Punk", title="Touch", length=498.0)
+    item.path = str(tmp_path / "touch.mp3").encode()
+    lib.add(item)
+    found = TrackInfo(artist="Daft Punk", title="Touch", length=498)
+    missing = TrackInfo(artist="Daft Punk", title="Contact", length=381)
+
+    state = st.PlaylistState.load(str(tmp_path / "pl.txt"))
+    assert state.tracks == []
+    state.update("abc", "pl", {found: item, missing: None})
+    state.save()
+
+    state = st.PlaylistState.load(str(tmp_path / "pl.txt"))
+    assert state.fingerprint == "abc"
+    assert state.title == "pl"
+    new = TrackInfo(artist="Daft Punk", title="Voyager", length=227)
+    matched = state.resolve(lib, [found, missing, new])
+    assert list(matched) == [found, missing, new]
+    assert matched[found].id == item.id
+    assert matched[missing] is None and matched[new] is None
+
+    # items that left the library are matched again
+    item.remove()
+    assert state.resolve(lib, [found])[found] is None
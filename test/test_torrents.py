@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+import redlist
+from redlist import bencode
+from redlist import torrents
+
+
+def encode(value):
+    "just enough bencoding to write test torrents"
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode("utf8")
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(encode(v) for v in value) + b"e"
+    return b"d" + b"".join(encode(k) + encode(v) for k, v in sorted(value.items())) + b"e"
+
+
+INFO = {
+    "name": "Kid Koala - Carpal Tunnel Syndrome",
+    "piece length": 16384,
+    "files": [
+        {"length": 100, "path": ["01 - Skanky Panky.mp3"]},
+        {"length": 50, "path": ["scans", "cover.jpg"]},
+    ],
+}
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(redlist.config, "config_dir", lambda: str(tmp_path / "cfg"))
+
+
+def test_decode():
+    assert bencode.decode(b"d3:keyl4:spami-3eee") == {b"key": [b"spam", -3]}
+    with pytest.raises(bencode.BencodeError):
+        bencode.decode(b"l4:spam")
+    with pytest.raises(bencode.BencodeError):
+        bencode.decode(b"i1ei2e")
+
+
+def test_info_hash():
+    import hashlib
+
+    data = encode({"announce": "https://flacsfor.me/x", "info": INFO})
+    meta, info_hash = bencode.decode_torrent(data)
+    assert info_hash == hashlib.sha1(encode(INFO)).hexdigest()
+    assert meta[b"info"][b"name"] == INFO["name"].encode()
+
+
+def test_torrent_index(tmp_path, config_dir):
+    data = encode({"announce": "https://flacsfor.me/x", "info": INFO})
+    (tmp_path / "Kid Koala - Carpal Tunnel Syndrome-1364328.torrent").write_bytes(data)
+    index = torrents.TorrentIndex(tmp_path)
+    (saved,) = index.torrents.values()
+    assert saved.torrent_id == 1364328
+    assert saved.files == ["01 - Skanky Panky.mp3", "scans/cover.jpg"]
+    assert saved.size == 150
+    assert index.find({"torrentId": 1364328}) == saved
+    assert index.find({"torrentId": 1, "infoHash": saved.info_hash.upper()}) == saved
+    assert index.find({"torrentId": 1}) is None
+
+    # unchanged files come from the cache
+    index = torrents.TorrentIndex(tmp_path)
+    assert list(index.torrents.values()) == [saved]
+    os.remove(tmp_path / saved.filename)
+    index.refresh()
+    assert len(index) == 0
+
+
+def test_torrent_index_missing_directory(tmp_path, config_dir):
+    index = torrents.TorrentIndex(tmp_path / "not yet made")
+    assert len(index) == 0
+    assert index.find({"torrentId": 1}) is None
@@ -1,3 +1,58 @@
 import pytest
 
 import redlist.utils as utils
+
+
+def group(torrent_id, size, **flags):
+    return {"torrent": {"torrentId": torrent_id, "size": size, **flags}}
+
+
+def test_plan_fl_tokens():
+    groups = [group(1, 50), group(2, 500), group(3, 300), group(4, 900, isFreeleech=True),
+              group(5, 400)]
+    assert utils.plan_fl_tokens(groups, tokens=2) == {2, 5}
+    assert utils.plan_fl_tokens(groups, tokens=None, min_size=100) == {2, 3, 5}
+    assert utils.plan_fl_tokens(groups, tokens=0) == set()
+
+
+class FakeAPI:
+    user_id = 1
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.requests = 0
+
+    async def request(self, action, **kwargs):
+        self.requests += 1
+        return {"response": {"stats": {"buffer": self.buffer}}}
+
+
+@pytest.mark.asyncio
+async def test_buffer_ledger():
+    api = FakeAPI(1000)
+    ledger = utils.BufferLedger(api)
+    groups = [group(1, 300), group(2, 400)]
+    assert await ledger.estimate(groups) == 300
+    assert await ledger.estimate(groups, fl_ids={2}) == 700
+    with pytest.raises(utils.NotEnoughDownloadBuffer):
+        await ledger.estimate(groups + [group(3, 300)])
+
+    await ledger.reserve(300)
+    await ledger.reserve(400)
+    with pytest.raises(utils.NotEnoughDownloadBuffer):
+        await ledger.reserve(300)
+    ledger.release(400)
+    await ledger.reserve(300)
+    assert ledger.remaining == 400
+    assert api.requests == 1
+
+    # going past the buffer is allowed for one reservation only
+    await ledger.reserve(500, strict=False)
+    with pytest.raises(utils.NotEnoughDownloadBuffer):
+        await ledger.reserve(100)
+
+    # a new daemon job starts from a fresh buffer with nothing reserved
+    api.buffer = 2000
+    ledger.reset()
+    assert await ledger.estimate(groups) == 1300
+    assert api.requests == 2